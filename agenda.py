@@ -15,18 +15,54 @@
    Appt: added from_iso_date
          added start_isoformat
          added end_isoformat
+         times kept as integer seconds (begin_epoch, end_epoch)
 
 """
 
+import collections
 import datetime
-import dateutil.parser as dt
+import heapq
+import re
 from dateutil import tz
+import isotime
+
+# numpy is optional; only AgendaArray needs it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+HAVE_NUMPY = np is not None
+
+# Appt keeps its times as whole seconds of local (wall-clock) time
+# since the start of 1970, with no time zone.  Whole days start at
+# multiples of SECONDS_PER_DAY.
+EPOCH = datetime.datetime(1970, 1, 1)
+SECONDS_PER_DAY = 24 * 60 * 60
+_EPOCH_ORDINAL = EPOCH.toordinal()
+
+def epoch_seconds(day, time):
+    """Seconds since EPOCH of a datetime.date and datetime.time"""
+    return ((day.toordinal() - _EPOCH_ORDINAL) * SECONDS_PER_DAY +
+            time.hour * 3600 + time.minute * 60 + time.second)
+
+def day_number(day):
+    """Days since EPOCH of a datetime.date; appointments on that
+    day have begin_epoch // SECONDS_PER_DAY equal to it."""
+    return day.toordinal() - _EPOCH_ORDINAL
+
 class Appt:
 
     """
     A single appointment, starting on a particular
     date and time, and ending at a later time the same day.
+
+    Times are stored as integer seconds since EPOCH in
+    begin_epoch and end_epoch, so comparing, intersecting
+    and merging appointments is integer arithmetic.  The
+    begin and end datetime.datetime attributes are built
+    from those on demand.
     """
+    __slots__ = ("begin_epoch", "end_epoch", "desc")
     
     def __init__(self, day, begin, end, desc): #changed
         """Create an appointment on date
@@ -48,18 +84,47 @@ class Appt:
                 datetime.time(17,45))
             (December 1 from 4:30pm to 5:45pm)
         """
-        self.begin = datetime.datetime.combine(day, begin)
-        self.end = datetime.datetime.combine(day, end)
-        if begin >= end :
+        self.begin_epoch = epoch_seconds(day, begin)
+        self.end_epoch = epoch_seconds(day, end)
+        if self.begin_epoch >= self.end_epoch :
             raise ValueError("Appointment end must be after begin")
         self.desc = desc
         return
 
+    @classmethod
+    def from_epoch(cls, begin, end, desc):
+        """Factory: an appointment from begin to end seconds since
+        EPOCH, which must fall on the same day.
+
+        Raises:
+            ValueError if appointment ends before it begins, or
+            on a later day
+        """
+        if begin >= end:
+            raise ValueError("Appointment end must be after begin")
+        if begin // SECONDS_PER_DAY != (end - 1) // SECONDS_PER_DAY:
+            raise ValueError("Appointment must begin and end on the same day")
+        result = cls.__new__(cls)
+        result.begin_epoch = begin
+        result.end_epoch = end
+        result.desc = desc
+        return result
+
+    @property
+    def begin(self):
+        """When the appointment starts, as a datetime.datetime"""
+        return EPOCH + datetime.timedelta(seconds=self.begin_epoch)
+
+    @property
+    def end(self):
+        """When the appointment ends, as a datetime.datetime"""
+        return EPOCH + datetime.timedelta(seconds=self.end_epoch)
+
     #added this class method to make Appt from an iso formated date time.
     @classmethod
     def from_iso_date(cls, start, finish, desc):
-        begin = dt.parse(start)
-        end = dt.parse(finish)
+        begin = isotime.parse(start)
+        end = isotime.parse(finish)
 
         if begin.date() != end.date():
             raise ValueError("The start and finish should have the same dates.")
@@ -112,7 +177,7 @@ class Appt:
         Returns: 
         	True iff this Appt is done by the time other begins.
         """
-        return self.end <= other.begin
+        return self.end_epoch <= other.begin_epoch
         
     def __gt__(self, other):
         """Does other appointment finish before this begins?
@@ -133,7 +198,8 @@ class Appt:
             True iff there exists some duration (greater than zero)
             between this Appt and other. 
         """
-        return  not (self < other or other < self)
+        return (self.begin_epoch < other.end_epoch and
+                other.begin_epoch < self.end_epoch)
             
     def intersect(self, other, desc=""):
         """Return an appointment representing the period in
@@ -156,9 +222,8 @@ class Appt:
         # We know the day must be the same. 
         # Find overlap of times: 
         #   Later of two begin times, earlier of two end times
-        begin_time = max(self.begin.time(), other.begin.time())
-        end_time = min(self.end.time(), other.end.time())
-        return Appt(self.begin.date(), begin_time, end_time, desc)
+        return Appt.from_epoch(max(self.begin_epoch, other.begin_epoch),
+                               min(self.end_epoch, other.end_epoch), desc)
 
     def union(self, other, desc=""):
         """Return an appointment representing the combined period in
@@ -181,9 +246,8 @@ class Appt:
         # We know the day must be the same. 
         # Find overlap of times: 
         #   Earlier of two begin times, later of two end times
-        begin = min(self.begin, other.begin)
-        end = max(self.end, other.end)
-        return Appt(self.begin.date(), begin.time(), end.time(), desc)
+        return Appt.from_epoch(min(self.begin_epoch, other.begin_epoch),
+                               max(self.end_epoch, other.end_epoch), desc)
 
     def __str__(self):
         """String representation of appointment.
@@ -194,8 +258,9 @@ class Appt:
         into parts:  Split on '|', then split on whitespace,
         then split date on '.' and times on ':'.
         """
-        daystr = self.begin.date().strftime("%Y.%m.%d ")
-        begstr = self.begin.strftime("%H:%M ")
+        begin = self.begin
+        daystr = begin.strftime("%Y.%m.%d ")
+        begstr = begin.strftime("%H:%M ")
         endstr = self.end.strftime("%H:%M ")
         return daystr + begstr + endstr + "| " + self.desc
 
@@ -207,34 +272,88 @@ class Agenda:
     def __init__(self):
         """An empty agenda."""
         self.appts = [ ]
+        self._index = None   # IntervalIndex, built when first needed
         
     @classmethod
-    def from_file(cls, f):
+    def from_file(cls, f, errors=None):
         """Factory: Read an agenda from a file.
         
         Arguments: 
             f:  A file object (as returned by io.open) or
                an object that emulates a file (like stringio). 
+            errors:  (optional) A list to collect a ParseError in
+               for each bad line (see iter_file)
         returns: 
             An Agenda object
         """
         agenda = cls()
-        for line in f:
+        agenda.appts = list(cls.iter_file(f, errors))
+        return agenda
+
+    @classmethod
+    def iter_file(cls, f, errors=None):
+        """Generator: The appointments in an agenda file, one at a
+        time as the file is read, so a large file never has to be
+        held in memory.
+
+        Arguments:
+            f:  A file object or an object that emulates a file,
+               as for from_file
+            errors:  If a list, a ParseError is appended to it for each
+               line that could not be read.  Otherwise those lines
+               are reported with print.
+        Yields:
+            Appt objects, in the order they appear in the file.
+        """
+        days = { }   # (year, month, day) -> seconds since EPOCH, for reuse
+        for lineno, line in enumerate(f, 1):
             line = line.strip()
             if line == "" or line.startswith("#"):
                 # Skip blank lines and comments
-                pass
-            else: 
-                try: 
-                    agenda.append(Appt.from_string(line))
-                except ValueError as err: 
+                continue
+            try:
+                yield _parse_appt(line, days)
+            except ValueError as err:
+                if errors is None:
                     print("Failed on line: ", line)
                     print(err)
-        return agenda
+                else:
+                    errors.append(ParseError(lineno, line, str(err)))
 
     def append(self,appt):
         """Add an Appt to the agenda."""
         self.appts.append(appt)
+        self._index = None
+
+    def index(self):
+        """The IntervalIndex of this agenda's appointments.  It is
+        built on first use and kept until the agenda changes through
+        append or normalize (code that assigns to or edits .appts
+        directly must set ._index to None itself).
+        """
+        if self._index is None:
+            self._index = IntervalIndex(self.appts)
+        return self._index
+
+    def overlapping(self, appt):
+        """The appointments in this agenda that overlap appt,
+        in order by begin time.  O(log n + k) after the index
+        is built.
+        """
+        return self.index().overlapping(appt.begin_epoch, appt.end_epoch)
+
+    def at(self, when):
+        """The appointments in progress at a datetime.datetime,
+        in order by begin time.
+        """
+        moment = epoch_seconds(when, when)
+        return self.index().overlapping(moment, moment + 1)
+
+    def is_free(self, appt):
+        """Is the period of appt clear of every appointment in
+        this agenda?
+        """
+        return self.index().is_free(appt.begin_epoch, appt.end_epoch)
 
     # def get_date(self):
     #     """Returns the date of the first appt in the agenda"""
@@ -259,13 +378,75 @@ class Agenda:
         """
         default_desc = (desc == "")
         result = Agenda()
-        for thisappt in self.appts:
-            if default_desc: 
+        for i, j in _overlapping_pairs(self.appts, other.appts):
+            thisappt = self.appts[i]
+            if default_desc:
                 desc = thisappt.desc
-            for otherappt in other.appts:
-                if thisappt.overlaps(otherappt):
-                    result.append(thisappt.intersect(otherappt,desc))
-        
+            result.append(thisappt.intersect(other.appts[j],desc))
+
+        return result
+
+    @classmethod
+    def intersect_all(cls, agendas, quorum=None, desc=""):
+        """Factory: The times when at least quorum of several
+        agendas have an appointment.  With the default quorum
+        (all of them) this is the time common to every agenda,
+        like chaining intersect, but done in a single pass over
+        all the agendas instead of building one intermediate
+        agenda per participant.
+
+        Each agenda is normalized (on a copy) first, so an agenda
+        counts once even where its own appointments overlap.
+
+        Arguments:
+           agendas: A list of Agenda, e.g., the free times of
+                each participant in a meeting.
+           quorum:  How many of the agendas must have an appointment
+                at the same time.  Defaults to len(agendas).
+           desc:  If provided, this string becomes the title of
+                all the appointments in the result.  Otherwise
+                each title is taken from the first agenda (in the
+                order given) that is part of the quorum when the
+                appointment starts.
+        Returns:
+           A new normalized Agenda.  Blocks of time that meet
+           end to end are joined into a single appointment.
+        """
+        if quorum is None:
+            quorum = len(agendas)
+        result = cls()
+        if quorum < 1 or quorum > len(agendas):
+            return result
+
+        # Each normalized agenda is a sorted stream of boundaries;
+        # merge the streams, ending appointments before starting
+        # new ones at the same moment so touching appointments
+        # don't make a zero-length overlap.
+        def boundaries(k, agenda):
+            for appt in agenda.normalized().appts:
+                yield (appt.begin_epoch, 1, k, appt)
+                yield (appt.end_epoch, 0, k, appt)
+        streams = [ boundaries(k, agenda) for k, agenda in enumerate(agendas) ]
+
+        active = { }    # Agenda number -> its appointment in progress
+        start = None
+        title = desc
+        for when, starting, k, appt in heapq.merge(*streams):
+            if starting:
+                active[k] = appt
+                if len(active) == quorum:
+                    start = when
+                    if desc == "":
+                        title = active[min(active)].desc
+            else:
+                if len(active) == quorum and when > start:
+                    if result.appts and result.appts[-1].end_epoch == start:
+                        # One agenda left just as another joined;
+                        # keep it as one block of time.
+                        joined = result.appts.pop()
+                        start, title = joined.begin_epoch, joined.desc
+                    result.append(Appt.from_epoch(start, when, title))
+                del active[k]
         return result
 
     def normalize(self):
@@ -279,7 +460,7 @@ class Agenda:
         if len(self.appts) == 0:
             return
 
-        ordering = lambda ap: ap.begin
+        ordering = lambda ap: ap.begin_epoch
         self.appts.sort(key=ordering)
 
         normalized = [ ]
@@ -300,6 +481,7 @@ class Agenda:
         # print("Last appt: ", cur)
         normalized.append(cur)
         self.appts = normalized
+        self._index = None
 
     def normalized(self):
         """
@@ -332,27 +514,79 @@ class Agenda:
         """
         copy = self.normalized()
         comp = Agenda()
-        day = freeblock.begin.date()
         desc = freeblock.desc
-        cur_time = freeblock.begin
+        cur_time = freeblock.begin_epoch
+        end_time = freeblock.end_epoch
         for appt in copy.appts:
             if appt < freeblock:
                 continue
             if appt > freeblock:
-                if cur_time < freeblock.end:
-                    comp.append(Appt(day,cur_time.time(),freeblock.end.time(), desc))
-                    cur_time = freeblock.end
                 break
-            if cur_time < appt.begin:
+            if cur_time < appt.begin_epoch:
                 # print("Creating free time from", cur_time, "to", appt.begin)
-                comp.append(Appt(day, cur_time.time(), appt.begin.time(), desc))
-            cur_time = max(appt.end,cur_time)
+                comp.append(Appt.from_epoch(cur_time, appt.begin_epoch, desc))
+            cur_time = max(appt.end_epoch,cur_time)
 
-        if cur_time < freeblock.end:
+        if cur_time < end_time:
             # print("Creating final free time from", cur_time, "to", freeblock.end)
-            comp.append(Appt(day, cur_time.time(), freeblock.end.time(), desc))
+            comp.append(Appt.from_epoch(cur_time, end_time, desc))
         return comp
 
+    def complement_range(self, start_date, end_date, daily_begin, daily_end,
+                         desc=""):
+        """The complement of this agenda within the same hours of
+        each day in a range of dates: like calling complement with
+        a freeblock for each day, but the agenda is normalized once
+        and swept once for the whole range.
+
+        Args:
+           start_date, end_date: datetime.date; the first and last
+               days (inclusive)
+           daily_begin, daily_end: datetime.time; the hours to look
+               for free time in each day
+           desc: Description of the free time appointments
+        Returns:
+           A pair of lists (busy, free), each with one Agenda per
+           day from start_date to end_date.  busy has the day's
+           appointments from this agenda, normalized; free has the
+           times within the day's hours that are not in them.
+        Raises:
+           ValueError if daily_end is not after daily_begin
+        """
+        window = Appt(start_date, daily_begin, daily_end, desc)
+        first_day = window.begin_epoch // SECONDS_PER_DAY
+        opens = window.begin_epoch % SECONDS_PER_DAY
+        closes = window.end_epoch - first_day * SECONDS_PER_DAY
+        ndays = (end_date - start_date).days + 1
+
+        appts = self.normalized().appts
+        i = 0
+        busy_days = [ ]
+        free_days = [ ]
+        for day in range(first_day, first_day + ndays):
+            midnight = day * SECONDS_PER_DAY
+            # Appointments on days before this one aren't reported
+            while i < len(appts) and appts[i].begin_epoch < midnight:
+                i += 1
+            busy = Agenda()
+            free = Agenda()
+            cur_time = midnight + opens
+            end_time = midnight + closes
+            while (i < len(appts) and
+                   appts[i].begin_epoch < midnight + SECONDS_PER_DAY):
+                appt = appts[i]
+                busy.appts.append(appt)
+                if appt.end_epoch > cur_time and appt.begin_epoch < end_time:
+                    if cur_time < appt.begin_epoch:
+                        free.appts.append(Appt.from_epoch(cur_time, appt.begin_epoch, desc))
+                    cur_time = appt.end_epoch
+                i += 1
+            if cur_time < end_time:
+                free.appts.append(Appt.from_epoch(cur_time, end_time, desc))
+            busy_days.append(busy)
+            free_days.append(free)
+        return busy_days, free_days
+
 
 
     def __len__(self):
@@ -377,12 +611,319 @@ class Agenda:
         for i in range(len(self.appts)):
             mine = self.appts[i]
             theirs = other.appts[i]
-            if not (mine.begin == theirs.begin and
-                    mine.end == theirs.end):
+            if not (mine.begin_epoch == theirs.begin_epoch and
+                    mine.end_epoch == theirs.end_epoch):
                 return False
         return True
 
 
+# A line that failed to parse: line number (from 1), text, and why
+ParseError = collections.namedtuple("ParseError", ["lineno", "line", "message"])
+
+# The usual form of an Appt literal (see Appt.__str__), e.g.
+#   2012.10.31 13:00 13:50 | CIS 210 lecture
+_APPT_PATTERN = re.compile(r"(\d{4})\.(\d{1,2})\.(\d{1,2})\s+"
+                           r"(\d{1,2}):(\d\d)\s+(\d{1,2}):(\d\d)\s*\|([^|]*)$")
+
+def _parse_appt(line, days):
+    """Appt.from_string, faster for lines in the usual form: one
+    precompiled match, and times taken straight from the digits
+    instead of strptime.  Anything else goes through from_string,
+    so errors are reported the same way.
+
+    Arguments:
+        line:  The text of an appointment, stripped
+        days:  A dict caching the start of each (year, month, day)
+    """
+    match = _APPT_PATTERN.match(line)
+    if match is None:
+        return Appt.from_string(line)
+    year, month, day, bhour, bmin, ehour, emin, desc = match.groups()
+    bhour, bmin, ehour, emin = int(bhour), int(bmin), int(ehour), int(emin)
+    if bhour > 23 or ehour > 23 or bmin > 59 or emin > 59:
+        return Appt.from_string(line)
+    key = (year, month, day)
+    midnight = days.get(key)
+    if midnight is None:
+        date = datetime.date(int(year), int(month), int(day))
+        midnight = days[key] = epoch_seconds(date, datetime.time())
+    return Appt.from_epoch(midnight + bhour * 3600 + bmin * 60,
+                           midnight + ehour * 3600 + emin * 60, desc.strip())
+
+def _overlapping_pairs(mine, theirs):
+    """Find every overlapping pair of appointments between two lists.
+
+    Sweeps both lists once in order of begin time, keeping the
+    appointments still in progress from each side in a heap keyed
+    by end time.  Each appointment is paired with the ones from the
+    other side that are still in progress when it begins, so each
+    overlapping pair is found exactly once.
+
+    Arguments:
+        mine:   A list of Appt
+        theirs: A list of Appt
+    Returns:
+        A list of (i, j) index pairs such that mine[i] overlaps
+        theirs[j], in the order a nested loop over mine and then
+        theirs would produce them.
+    """
+    starts = [ (appt.begin_epoch, 0, i) for i, appt in enumerate(mine) ]
+    starts += [ (appt.begin_epoch, 1, j) for j, appt in enumerate(theirs) ]
+    starts.sort()
+
+    sides = (mine, theirs)
+    active = ([ ], [ ])   # Heaps of (end, index) still in progress
+    pairs = [ ]
+    for begin, side, k in starts:
+        others = active[1 - side]
+        # Anything that ended by now can't overlap this or anything later
+        while others and others[0][0] <= begin:
+            heapq.heappop(others)
+        for end, other in others:
+            pairs.append((k, other) if side == 0 else (other, k))
+        heapq.heappush(active[side], (sides[side][k].end_epoch, k))
+
+    pairs.sort()
+    return pairs
+
+
+class IntervalIndex:
+    """A static interval tree over a list of appointments, for
+    answering "what overlaps this period?" without scanning them all.
+
+    The appointments are sorted by begin time and treated as an
+    implicit balanced binary tree (the middle element of each range
+    is the root of that range), where each node also records the
+    latest end time in its subtree.  A query skips every subtree
+    that ends too early or begins too late, so it costs
+    O(log n + k) for k results.  Building the index is O(n log n).
+    """
+
+    def __init__(self, appts):
+        """Index a list of Appt (the list is not modified)"""
+        self.appts = sorted(appts, key=lambda appt: appt.begin_epoch)
+        self.begins = [ appt.begin_epoch for appt in self.appts ]
+        self.ends = [ appt.end_epoch for appt in self.appts ]
+        self.max_end = list(self.ends)
+        self._augment(0, len(self.appts))
+
+    def _augment(self, lo, hi):
+        """Fill in max_end for the subtree over appts[lo:hi]"""
+        if lo >= hi:
+            return -1
+        mid = (lo + hi) // 2
+        latest = max(self.ends[mid], self._augment(lo, mid),
+                     self._augment(mid + 1, hi))
+        self.max_end[mid] = latest
+        return latest
+
+    def _search(self, begin, end, lo, hi, found, limit):
+        """Append to found the appointments in appts[lo:hi] that
+        overlap the period from begin to end, stopping early once
+        there are limit of them.  Returns True iff it stopped early.
+        """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.max_end[mid] <= begin:
+                return False    # Everything in this subtree is over
+            if self._search(begin, end, lo, mid, found, limit):
+                return True
+            if self.begins[mid] >= end:
+                return False    # This and everything after start too late
+            if self.ends[mid] > begin:
+                found.append(self.appts[mid])
+                if len(found) == limit:
+                    return True
+            lo = mid + 1
+        return False
+
+    def overlapping(self, begin, end):
+        """Appointments overlapping begin to end (seconds since EPOCH),
+        in order by begin time."""
+        found = [ ]
+        self._search(begin, end, 0, len(self.appts), found, None)
+        return found
+
+    def is_free(self, begin, end):
+        """True iff no appointment overlaps begin to end"""
+        return not self._search(begin, end, 0, len(self.appts), [ ], 1)
+
+    def __len__(self):
+        """Number of appointments indexed"""
+        return len(self.appts)
+
+
+class AgendaArray:
+    """An agenda stored column-wise, for large agendas.
+
+    The begin and end times of all appointments are kept in two
+    numpy int64 arrays (seconds since EPOCH, like Appt.begin_epoch),
+    and descriptions are kept once each in a side table that rows
+    refer to by number.  normalize, complement and intersect work
+    on whole arrays at once instead of looping over Appt objects.
+
+    Requires numpy (see HAVE_NUMPY).
+    """
+
+    def __init__(self, begin=(), end=(), desc_ids=(), descs=()):
+        """An agenda of len(begin) appointments; appointment i is
+        from begin[i] to end[i] with description descs[desc_ids[i]].
+        """
+        if np is None:
+            raise ImportError("AgendaArray requires numpy")
+        self.begin = np.asarray(begin, dtype=np.int64)
+        self.end = np.asarray(end, dtype=np.int64)
+        self.desc_ids = np.asarray(desc_ids, dtype=np.intp)
+        self.descs = list(descs)
+
+    @classmethod
+    def from_agenda(cls, agenda):
+        """Factory: An AgendaArray with the appointments of an Agenda
+        (or any sequence of Appt), in the same order.
+        """
+        if np is None:
+            raise ImportError("AgendaArray requires numpy")
+        appts = list(agenda)
+        n = len(appts)
+        begin = np.fromiter((appt.begin_epoch for appt in appts), np.int64, n)
+        end = np.fromiter((appt.end_epoch for appt in appts), np.int64, n)
+        table = { }
+        desc_ids = np.fromiter((table.setdefault(appt.desc, len(table))
+                                for appt in appts), np.intp, n)
+        return cls(begin, end, desc_ids, table)
+
+    def to_agenda(self):
+        """A new Agenda with the same appointments, in the same order"""
+        result = Agenda()
+        descs = self.descs
+        result.appts = [ Appt.from_epoch(begin, end, descs[k])
+                         for begin, end, k in zip(self.begin.tolist(),
+                                                  self.end.tolist(),
+                                                  self.desc_ids.tolist()) ]
+        return result
+
+    def normalize(self):
+        """Merge overlapping appointments, as Agenda.normalize does
+        (including the combined descriptions).  After normalize, the
+        appointments are in order by begin time and end time, with
+        no overlaps.
+        """
+        n = len(self)
+        if n == 0 or np.all(self.begin[1:] >= self.end[:-1]):
+            # Already in order with no overlaps
+            return
+        order = np.argsort(self.begin, kind="mergesort")
+        begin = self.begin[order]
+        end = self.end[order]
+        desc_ids = self.desc_ids[order]
+
+        # An appointment starts a new block unless it begins before
+        # everything earlier has ended.
+        reach = np.maximum.accumulate(end)
+        starts = np.ones(n, dtype=bool)
+        starts[1:] = begin[1:] >= reach[:-1]
+        first = np.flatnonzero(starts)
+        last = np.append(first[1:], n) - 1
+
+        descs = list(self.descs)
+        merged_ids = desc_ids[first]
+        for block in np.flatnonzero(last > first).tolist():
+            parts = desc_ids[first[block]:last[block] + 1].tolist()
+            merged_ids[block] = len(descs)
+            descs.append(" ".join(self.descs[k] for k in parts))
+
+        self.begin = begin[first]
+        self.end = reach[last]
+        self.desc_ids = merged_ids
+        self.descs = descs
+
+    def normalized(self):
+        """A normalized copy of this agenda"""
+        copy = AgendaArray(self.begin, self.end, self.desc_ids, self.descs)
+        copy.normalize()
+        return copy
+
+    def intersect(self, other, desc=""):
+        """Return a new AgendaArray of the time in common between
+        this agenda and the other.
+
+        Unlike Agenda.intersect, both agendas are normalized first,
+        so time that overlaps several appointments of one agenda is
+        reported once.  Descriptions come from this agenda (as
+        normalized), unless they are overridden with desc.
+        """
+        mine = self.normalized()
+        theirs = other.normalized()
+        # Appointments of the other agenda overlapping my i'th are
+        # theirs[lo[i]:hi[i]]; both columns of a normalized agenda
+        # are sorted, so binary search finds them.
+        lo = np.searchsorted(theirs.end, mine.begin, side="right")
+        hi = np.searchsorted(theirs.begin, mine.end, side="left")
+        counts = np.maximum(hi - lo, 0)
+        rows = np.repeat(np.arange(len(mine)), counts)
+        offsets = np.cumsum(counts) - counts
+        cols = lo[rows] + np.arange(len(rows)) - offsets[rows]
+
+        begin = np.maximum(mine.begin[rows], theirs.begin[cols])
+        end = np.minimum(mine.end[rows], theirs.end[cols])
+        if desc == "":
+            return AgendaArray(begin, end, mine.desc_ids[rows], mine.descs)
+        return AgendaArray(begin, end, np.zeros(len(rows), dtype=np.intp), [desc])
+
+    def complement(self, freeblock):
+        """Produce the complement of this agenda within a block of
+        time, as Agenda.complement does.
+
+        Args:
+           freeblock: An Appt, or an AgendaArray of several blocks
+               of time (e.g., the same hours on each of many days)
+               to find free time in, all in one pass.
+        Returns:
+           A new AgendaArray of the times within freeblock and not
+           within appointments in this agenda, described like the
+           block of freeblock they fall in.
+        """
+        if not isinstance(freeblock, AgendaArray):
+            freeblock = AgendaArray.from_agenda([freeblock])
+        busy = self.normalized()
+        edge = np.iinfo(np.int64)
+        begin = np.append(edge.min, busy.end)
+        end = np.append(busy.begin, edge.max)
+        # Blocks that touch (one ends as the next begins) have no
+        # gap between them
+        open_gaps = end > begin
+        gaps = AgendaArray(begin[open_gaps], end[open_gaps],
+                           np.zeros(int(open_gaps.sum()), dtype=np.intp), [""])
+        return freeblock.intersect(gaps)
+
+    def by_day(self, days):
+        """Split an agenda by day.
+
+        Arguments:
+           days: A sorted list of datetime.date
+        Returns:
+           A list of Agenda, one per day in days, with the
+           appointments on that day.  Appointments on days that
+           are not listed are left out.
+        """
+        order = np.argsort(self.begin, kind="mergesort")
+        begin = self.begin[order]
+        starts = np.array([ epoch_seconds(day, datetime.time())
+                            for day in days ], dtype=np.int64)
+        lo = np.searchsorted(begin, starts, side="left")
+        hi = np.searchsorted(begin, starts + SECONDS_PER_DAY, side="left")
+        result = [ ]
+        for first, last in zip(lo.tolist(), hi.tolist()):
+            rows = order[first:last]
+            result.append(AgendaArray(self.begin[rows], self.end[rows],
+                                      self.desc_ids[rows], self.descs).to_agenda())
+        return result
+
+    def __len__(self):
+        """Number of appointments"""
+        return len(self.begin)
+
+
 #########################
 #  Self-test invoked when module is run
 #  as main program. 
@@ -0,0 +1,147 @@
+"""Availability on a fixed grid of minutes.
+
+   An Availability records which slots of each day are busy, where
+   a day is cut into slots of a fixed length (granularity minutes,
+   e.g. 5 or 15).  The busy slots of a day are the bits of one
+   Python int: bit i is set if anything is scheduled in slot i.
+   Combining many people's availability is then bitwise OR (busy if
+   anyone is busy) or AND (busy only if everyone is) on those ints,
+   one per day, instead of interval arithmetic on Appt objects.
+
+   Appointments are rounded outward to the grid when they are added
+   (a 9:05 to 9:20 meeting makes both 9:00-9:15 and 9:15-9:30 busy),
+   and free blocks are rounded inward, so free time found on the
+   grid is always really free.  When every time is on the grid the
+   free blocks are exactly those Agenda.complement finds.
+"""
+
+from agenda import Appt, Agenda, SECONDS_PER_DAY
+
+MINUTES_PER_DAY = 24 * 60
+
+class Availability:
+    """Busy slots of each day, on a grid of granularity minutes."""
+
+    def __init__(self, granularity=15):
+        """An availability with nothing busy.
+
+        Arguments:
+            granularity: Minutes per slot; must divide a day evenly.
+        Raises:
+            ValueError if granularity does not divide a day evenly
+        """
+        if granularity < 1 or MINUTES_PER_DAY % granularity != 0:
+            raise ValueError("Granularity must divide a day evenly")
+        self.granularity = granularity
+        self.slot = granularity * 60   # Seconds per slot
+        self.busy = { }   # Day number (days since EPOCH) -> bits of busy slots
+
+    @classmethod
+    def from_agenda(cls, agenda, granularity=15):
+        """Factory: The availability of someone busy at the
+        appointments of an agenda."""
+        result = cls(granularity)
+        for appt in agenda:
+            result.add(appt)
+        return result
+
+    @classmethod
+    def combine(cls, availabilities):
+        """Factory: Busy whenever any of several availabilities is
+        busy, i.e., the times everyone is free are free."""
+        availabilities = list(availabilities)
+        if not availabilities:
+            return cls()
+        result = cls(availabilities[0].granularity)
+        for other in availabilities:
+            result |= other
+        return result
+
+    def add(self, appt):
+        """Mark the slots an Appt touches as busy"""
+        day, begin = divmod(appt.begin_epoch, SECONDS_PER_DAY)
+        end = appt.end_epoch - day * SECONDS_PER_DAY
+        first = begin // self.slot
+        last = -(-end // self.slot)    # Round up
+        bits = ((1 << (last - first)) - 1) << first
+        self.busy[day] = self.busy.get(day, 0) | bits
+
+    def _check(self, other):
+        if other.granularity != self.granularity:
+            raise ValueError("Availabilities must have the same granularity")
+
+    def __ior__(self, other):
+        """Also busy whenever other is busy"""
+        self._check(other)
+        for day, bits in other.busy.items():
+            self.busy[day] = self.busy.get(day, 0) | bits
+        return self
+
+    def __or__(self, other):
+        """Busy whenever either is busy"""
+        result = Availability(self.granularity)
+        result.busy = dict(self.busy)
+        result |= other
+        return result
+
+    def __and__(self, other):
+        """Busy only when both are busy"""
+        self._check(other)
+        result = Availability(self.granularity)
+        for day, bits in self.busy.items():
+            both = bits & other.busy.get(day, 0)
+            if both:
+                result.busy[day] = both
+        return result
+
+    def complement(self, freeblock):
+        """Free time within a block of time on one day, as
+        Agenda.complement does.  The block is rounded inward
+        to the grid.
+
+        Arguments:
+            freeblock: An Appt; the period to look for free time in.
+        Returns:
+            A new Agenda of the free blocks, described by freeblock.desc.
+        """
+        day, begin = divmod(freeblock.begin_epoch, SECONDS_PER_DAY)
+        end = freeblock.end_epoch - day * SECONDS_PER_DAY
+        first = -(-begin // self.slot)    # Round up
+        last = end // self.slot
+        result = Agenda()
+        if last <= first:
+            return result
+        window = ((1 << (last - first)) - 1) << first
+        free = window & ~self.busy.get(day, 0)
+
+        midnight = day * SECONDS_PER_DAY
+        while free:
+            # Lowest free slot, and the length of the run of free
+            # slots starting there
+            start = (free & -free).bit_length() - 1
+            run = free >> start
+            length = (~run & (run + 1)).bit_length() - 1
+            result.append(Appt.from_epoch(midnight + start * self.slot,
+                                          midnight + (start + length) * self.slot,
+                                          freeblock.desc))
+            free &= ~(((1 << length) - 1) << start)
+        return result
+
+    def free_days(self, days, begin, end, desc="Free Time"):
+        """Free blocks within the same hours of several days.
+
+        Arguments:
+            days: A list of datetime.date
+            begin, end: datetime.time; the hours to look in each day
+            desc: Description of the free blocks
+        Returns:
+            A list of Agenda, one per day.
+        """
+        return [ self.complement(Appt(day, begin, end, desc)) for day in days ]
+
+    def is_free(self, appt):
+        """Are all the slots an Appt touches free?"""
+        probe = Availability(self.granularity)
+        probe.add(appt)
+        day, bits = probe.busy.popitem()
+        return not (self.busy.get(day, 0) & bits)
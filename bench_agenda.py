@@ -0,0 +1,496 @@
+"""
+Benchmarks for agenda.py
+
+Run as a program (or with 'make bench') to print timings:
+    python3 bench_agenda.py
+
+These are not tests; nose skips this file.  Timings are
+the best of a few repeats, in milliseconds.
+
+The suite (run_suite) times the steps of finding free times on
+synthetic agendas of every combination of a few sizes, overlap
+densities, date ranges and numbers of participants, and can save
+its results as JSON to compare against a later commit:
+    python3 bench_agenda.py --suite --json before.json
+    (change things)
+    python3 bench_agenda.py --suite --json after.json --compare before.json
+"""
+import argparse
+import datetime
+import io
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import timeit
+
+from agenda import Appt, Agenda, AgendaArray, HAVE_NUMPY
+from availability import Availability
+import dateutil.parser
+import isotime
+import codec
+import flask
+from flask.sessions import SecureCookieSessionInterface
+
+def random_agenda(n, days=30, seed=0):
+    """
+    An agenda of n appointments scattered over a number of days,
+    each between 15 minutes and 3 hours long.  The same seed
+    always produces the same agenda.
+    """
+    rand = random.Random(seed)
+    first = datetime.date(2016, 11, 1)
+    agenda = Agenda()
+    for i in range(n):
+        day = first + datetime.timedelta(days=rand.randrange(days))
+        begin = rand.randrange(6 * 60, 20 * 60)
+        end = begin + rand.randrange(15, 3 * 60)
+        end = min(end, 23 * 60 + 59)
+        agenda.append(Appt(day,
+                           datetime.time(begin // 60, begin % 60),
+                           datetime.time(end // 60, end % 60),
+                           "Appt {}".format(i)))
+    return agenda
+
+def synthetic_agenda(events, days=30, density=0.3, seed=0):
+    """
+    An agenda of about 'events' appointments spread evenly over a
+    number of days from 11/1/2016, each 15 minutes to 2 hours long
+    and between 6am and midnight.  density, from 0 to 1, is the
+    share of appointments that overlap the one before; the rest
+    start after it ends.  A day that fills up gets fewer
+    appointments.  The same arguments always produce the same agenda.
+    """
+    rand = random.Random(seed)
+    first = datetime.date(2016, 11, 1)
+    agenda = Agenda()
+    for d in range(days):
+        day = first + datetime.timedelta(days=d)
+        count = events // days + (1 if d < events % days else 0)
+        begin, end = 6 * 60, 6 * 60
+        for i in range(count):
+            if i > 0 and rand.random() < density:
+                begin = rand.randrange(begin, end)
+            else:
+                begin = end + rand.randrange(0, 30)
+            if begin >= 23 * 60 + 45:
+                break
+            end = min(begin + rand.randrange(15, 120), 23 * 60 + 59)
+            agenda.append(Appt(day,
+                               datetime.time(begin // 60, begin % 60),
+                               datetime.time(end // 60, end % 60),
+                               "Appt {}".format(len(agenda.appts))))
+    return agenda
+
+def google_events(agenda):
+    """The appointments of an agenda as Google calendar event resources"""
+    return [ {"kind": "calendar#event", "id": "event{}".format(i),
+              "summary": appt.desc,
+              "start": {"dateTime": appt.start_isoformat()},
+              "end": {"dateTime": appt.end_isoformat()}}
+             for i, appt in enumerate(agenda) ]
+
+def best_of(fn, repeat=3):
+    """Best wall-clock time of fn() over several runs, in milliseconds"""
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+def nested_intersect(mine, theirs):
+    """The all-pairs Agenda.intersect this module replaced"""
+    result = Agenda()
+    for thisappt in mine.appts:
+        for otherappt in theirs.appts:
+            if thisappt.overlaps(otherappt):
+                result.append(thisappt.intersect(otherappt))
+    return result
+
+def bench_intersect(sizes=(250, 500, 1000, 2000, 4000)):
+    """
+    Agenda.intersect against the nested loop, for two agendas
+    of n appointments each spread over n/10 days (so the number
+    of overlaps grows linearly with n).
+    """
+    print("Agenda.intersect: n appts each, sweep vs. nested loop (ms)")
+    print("{:>8} {:>10} {:>10}".format("n", "sweep", "nested"))
+    for n in sizes:
+        mine = random_agenda(n, days=n // 10, seed=1)
+        theirs = random_agenda(n, days=n // 10, seed=2)
+        sweep = best_of(lambda: mine.intersect(theirs))
+        nested = best_of(lambda: nested_intersect(mine, theirs), repeat=1)
+        print("{:>8} {:>10.1f} {:>10.1f}".format(n, sweep, nested))
+
+def bench_intersect_all(counts=(2, 8, 32, 64), n=500):
+    """
+    Agenda.intersect_all against chaining Agenda.intersect, for k
+    participants with n appointments each over two months
+    (normalized, like each participant's free times).  Chaining
+    can't answer the half-quorum question at all; it is timed
+    with intersect_all alone.
+    """
+    print("Agenda.intersect_all: k agendas of {} appts, vs. chained (ms)".format(n))
+    print("{:>8} {:>10} {:>10} {:>10}".format("k", "k-way", "half", "chained"))
+    for k in counts:
+        agendas = [ random_agenda(n, days=60, seed=seed).normalized()
+                    for seed in range(k) ]
+        def chained():
+            result = agendas[0]
+            for agenda in agendas[1:]:
+                result = result.intersect(agenda)
+            return result
+        kway = best_of(lambda: Agenda.intersect_all(agendas))
+        half = best_of(lambda: Agenda.intersect_all(agendas, quorum=k // 2))
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            k, kway, half, best_of(chained)))
+
+def bench_arrays(sizes=(1000, 10000, 100000)):
+    """
+    AgendaArray against Agenda for normalize, intersect and the
+    complement of every day's 8am-6pm window, for n appointments
+    over n/20 days.  The Agenda complement is done a day at a time,
+    as flask_main does.  The AgendaArray timings leave out converting
+    from and to Agenda, which is timed separately.
+    """
+    if not HAVE_NUMPY:
+        print("AgendaArray: numpy is not installed, skipping")
+        return
+    print("AgendaArray vs. Agenda, n appts over n/20 days (ms)")
+    print("{:>8} {:>12} {:>10} {:>10}".format("n", "operation", "array", "agenda"))
+    for n in sizes:
+        days = n // 20
+        mine = random_agenda(n, days=days, seed=1)
+        theirs = random_agenda(n, days=days, seed=2)
+        first = datetime.date(2016, 11, 1)
+        windows = Agenda()
+        for d in range(days):
+            windows.append(Appt(first + datetime.timedelta(days=d),
+                                datetime.time(8), datetime.time(18), "Free"))
+        mine_array = AgendaArray.from_agenda(mine)
+        theirs_array = AgendaArray.from_agenda(theirs)
+        windows_array = AgendaArray.from_agenda(windows)
+        mine_array_norm = mine_array.normalized()
+        theirs_array_norm = theirs_array.normalized()
+        mine_norm = mine.normalized()
+        theirs_norm = theirs.normalized()
+        mine_by_day = { }
+        for appt in mine:
+            mine_by_day.setdefault(appt.begin.date(), Agenda()).append(appt)
+
+        def normalize_copy():
+            copy = Agenda()
+            copy.appts = list(mine.appts)
+            copy.normalize()
+        def complement_each_day():
+            return [ mine_by_day.get(window.begin.date(), Agenda()).complement(window)
+                     for window in windows ]
+        timings = [
+            ("convert", best_of(lambda: AgendaArray.from_agenda(mine).to_agenda()),
+                        float("nan")),
+            ("normalize", best_of(mine_array.normalized),
+                          best_of(normalize_copy)),
+            ("intersect", best_of(lambda: mine_array_norm.intersect(theirs_array_norm)),
+                          best_of(lambda: mine_norm.intersect(theirs_norm))),
+            ("complement", best_of(lambda: mine_array.complement(windows_array)),
+                           best_of(complement_each_day)),
+            ]
+        for name, array, agenda in timings:
+            print("{:>8} {:>12} {:>10.1f} {:>10.1f}".format(n, name, array, agenda))
+
+def bench_probes(sizes=(1000, 10000, 50000), probes=2000):
+    """
+    Checking many candidate slots against one agenda: Agenda.is_free
+    (interval index, including building it) against a linear scan.
+    """
+    print("Agenda.is_free: {} probes against n appts (ms)".format(probes))
+    print("{:>8} {:>10} {:>10}".format("n", "index", "scan"))
+    for n in sizes:
+        agenda = random_agenda(n, days=n // 10, seed=1)
+        slots = random_agenda(probes, days=n // 10, seed=2).appts
+        def indexed():
+            agenda._index = None
+            return [ agenda.is_free(slot) for slot in slots ]
+        def scan():
+            return [ not any(appt.overlaps(slot) for appt in agenda)
+                     for slot in slots ]
+        print("{:>8} {:>10.1f} {:>10.1f}".format(
+            n, best_of(indexed), best_of(scan, repeat=1)))
+
+def bench_availability(counts=(50, 200, 500), days=90, n=200):
+    """
+    Common free time of k people over a quarter: the 15-minute
+    Availability grid against the Agenda way (everyone's busy
+    appointments in one agenda, complemented a day at a time).
+    Building each person's grid is timed too.
+    """
+    print("Availability: common free time of k people, {} days (ms)".format(days))
+    print("{:>8} {:>10} {:>10} {:>10}".format("k", "build", "grid", "agenda"))
+    first = datetime.date(2016, 11, 1)
+    dates = [ first + datetime.timedelta(days=d) for d in range(days) ]
+    for k in counts:
+        agendas = [ random_agenda(n, days=days, seed=seed) for seed in range(k) ]
+        grids = [ Availability.from_agenda(agenda) for agenda in agendas ]
+        def grid():
+            return Availability.combine(grids).free_days(
+                dates, datetime.time(8), datetime.time(18))
+        windows = [ Appt(day, datetime.time(8), datetime.time(18), "Free")
+                    for day in dates ]
+        def agenda():
+            everyone = { }
+            for person in agendas:
+                for appt in person:
+                    everyone.setdefault(appt.begin.date(), Agenda()).append(appt)
+            return [ everyone.get(day, Agenda()).complement(window)
+                     for day, window in zip(dates, windows) ]
+        build = best_of(lambda: [ Availability.from_agenda(a) for a in agendas ], repeat=1)
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            k, build, best_of(grid), best_of(agenda, repeat=1)))
+
+def bench_parse(sizes=(10000, 100000)):
+    """
+    Reading an agenda file of n lines: Agenda.iter_file against
+    calling Appt.from_string on every line.
+    """
+    print("Agenda.iter_file: n lines (ms)")
+    print("{:>8} {:>10} {:>12}".format("n", "iter_file", "from_string"))
+    for n in sizes:
+        text = str(random_agenda(n, days=365, seed=1)) + "\n"
+        def streamed():
+            for appt in Agenda.iter_file(io.StringIO(text)):
+                pass
+        def per_line():
+            for line in io.StringIO(text):
+                Appt.from_string(line.strip())
+        print("{:>8} {:>10.1f} {:>12.1f}".format(
+            n, best_of(streamed), best_of(per_line)))
+
+def bench_isotime(n=20000):
+    """
+    Parsing n event timestamps (n/8 distinct): isotime.parse, cold
+    and with a warm cache, against dateutil.
+    """
+    first = datetime.datetime(2016, 11, 1, 8)
+    texts = [ (first + datetime.timedelta(minutes=15 * (i % (n // 8))))
+              .isoformat() + "-08:00" for i in range(n) ]
+    def cold():
+        isotime.parse.cache_clear()
+        for text in texts:
+            isotime.parse(text)
+    def warm():
+        for text in texts:
+            isotime.parse(text)
+    def general():
+        for text in texts:
+            dateutil.parser.parse(text)
+    print("isotime.parse: {} timestamps (ms)".format(n))
+    print("{:>10} {:>10} {:>10}".format("cold", "warm", "dateutil"))
+    print("{:>10.1f} {:>10.1f} {:>10.1f}".format(
+        best_of(cold), best_of(warm), best_of(general)))
+
+def sample_session(n, days):
+    """
+    A session as the free times page leaves it: n events over a
+    number of days (as flask_main.format_events makes them) and
+    each day's free and busy blocks (as flask_main.sessionify does).
+    """
+    agenda = random_agenda(n, days=days, seed=1)
+    events = [ {"kind": "calendar#event", "id": "event{:08d}".format(i),
+                "summary": appt.desc, "start": appt.start_isoformat(),
+                "end": appt.end_isoformat(), "show": True}
+               for i, appt in enumerate(agenda) ]
+    first = datetime.date(2016, 11, 1)
+    busy, free = [ ], [ ]
+    for d in range(days):
+        day = first + datetime.timedelta(days=d)
+        window = Appt(day, datetime.time(8), datetime.time(18), "Free Time")
+        today = Agenda()
+        for appt in agenda:
+            if appt.begin.date() == day:
+                today.append(appt)
+        today.normalize()
+        for schedule, blocks in ((busy, today), (free, today.complement(window))):
+            schedule.append([ {"descr": appt.desc, "start": appt.begin.isoformat(),
+                               "end": appt.end.isoformat()} for appt in blocks ])
+    return {"events": events, "busy": busy, "free": free}
+
+def bench_codec(sizes=((20, 7), (200, 30), (2000, 90))):
+    """
+    Session encoding: codec against Flask's signed JSON cookie
+    format, for n events over a number of days.  Sizes are in
+    bytes; times are encoding and decoding, in milliseconds.
+    """
+    app = flask.Flask(__name__)
+    app.secret_key = "bench"
+    cookie = SecureCookieSessionInterface().get_signing_serializer(app)
+    print("Session encoding: n events over d days (bytes, ms)")
+    print("{:>6} {:>4} {:>9} {:>9} {:>8} {:>8} {:>8} {:>8}".format(
+        "n", "d", "codec", "cookie", "enc", "dec", "c.enc", "c.dec"))
+    for n, days in sizes:
+        session = sample_session(n, days)
+        blob = codec.dumps(session)
+        signed = cookie.dumps(session)
+        print("{:>6} {:>4} {:>9} {:>9} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}".format(
+            n, days, len(blob), len(signed),
+            best_of(lambda: codec.dumps(session)), best_of(lambda: codec.loads(blob)),
+            best_of(lambda: cookie.dumps(session)), best_of(lambda: cookie.loads(signed))))
+
+def suite_cases(agendas, days):
+    """
+    (name, function) of each step timed by run_suite, for the
+    agendas of several participants over a number of days.  The
+    flask_main steps are left out if it can't be imported (it
+    needs the CONFIG and secrets of a configured checkout).
+    """
+    mine = agendas[0]
+    text = str(mine) + "\n"
+    normalized = [ agenda.normalized() for agenda in agendas ]
+    first = datetime.date(2016, 11, 1)
+    dates = [ first + datetime.timedelta(days=d) for d in range(days) ]
+    windows = [ Appt(day, datetime.time(8), datetime.time(18), "Free")
+                for day in dates ]
+    by_day = { }
+    for appt in mine:
+        by_day.setdefault(appt.begin.date(), Agenda()).append(appt)
+
+    def from_string():
+        for line in io.StringIO(text):
+            Appt.from_string(line.strip())
+    def normalize():
+        copy = Agenda()
+        copy.appts = list(mine.appts)
+        copy.normalize()
+    def complement():
+        return [ by_day.get(day, Agenda()).complement(window)
+                 for day, window in zip(dates, windows) ]
+    cases = [ ("Appt.from_string", from_string),
+              ("Agenda.normalize", normalize),
+              ("Agenda.complement", complement) ]
+    if len(agendas) > 1:
+        cases.append(("Agenda.intersect",
+                      lambda: normalized[0].intersect(normalized[1])))
+        cases.append(("Agenda.intersect_all",
+                      lambda: Agenda.intersect_all(normalized)))
+
+    try:
+        import flask_main
+    except Exception as err:
+        print("flask_main steps skipped: {}".format(err), file=sys.stderr)
+        return cases
+    events = [ ]
+    for agenda in agendas:
+        events.extend(google_events(agenda))
+    events.sort(key=lambda e: e["start"]["dateTime"])
+    lower = datetime.datetime(2016, 1, 1, 9).isoformat()
+    upper = datetime.datetime(2016, 1, 1, 17).isoformat()
+    dStart = datetime.datetime.combine(first, datetime.time()).isoformat()
+    dEnd = datetime.datetime.combine(dates[-1], datetime.time()).isoformat()
+    formatted = flask_main.format_events(events, lower, upper)
+    def format_events():
+        return flask_main.format_events(events, lower, upper)
+    # /freetime's path: events bucketed by day, then each day worked
+    # out by day_blocks.  Its caches are emptied first, to time a
+    # first visit; "busy_free_days warm" times a visit that finds
+    # every day remembered.
+    def busy_free_days():
+        flask_main.day_blocks.cache_clear()
+        flask_main.event_epochs.cache_clear()
+        return flask_main.busy_free_days(flask_main.bucket_events(formatted),
+                                         dStart, dEnd, lower, upper)
+    def busy_free_days_warm():
+        return flask_main.busy_free_days(flask_main.bucket_events(formatted),
+                                         dStart, dEnd, lower, upper)
+    def pipeline():
+        flask_main.day_blocks.cache_clear()
+        flask_main.event_epochs.cache_clear()
+        return flask_main.busy_free_days(
+            flask_main.bucket_events(flask_main.format_events(events, lower, upper)),
+            dStart, dEnd, lower, upper)
+    cases.append(("format_events", format_events))
+    cases.append(("get_busy_free_times", lambda: flask_main.get_busy_free_times(
+        formatted, dStart, dEnd, lower, upper)))
+    cases.append(("busy_free_days", busy_free_days))
+    cases.append(("busy_free_days warm", busy_free_days_warm))
+    cases.append(("pipeline", pipeline))
+    return cases
+
+def run_suite(events=(1000, 10000), densities=(0.1, 0.5), days=(30, 90),
+              participants=(2, 8)):
+    """
+    Time every step of suite_cases for each combination of the
+    parameters (events per participant, overlap density, days and
+    participants).  Prints a table as it goes, and returns a list
+    of results, one dict per step and combination.
+    """
+    results = [ ]
+    print("Suite: best of 3 (ms)")
+    print("{:>7} {:>7} {:>5} {:>4}  {:<22} {:>10}".format(
+        "events", "density", "days", "k", "step", "ms"))
+    for n, density, ndays, k in itertools.product(events, densities, days, participants):
+        agendas = [ synthetic_agenda(n, ndays, density, seed) for seed in range(k) ]
+        for name, fn in suite_cases(agendas, ndays):
+            ms = best_of(fn)
+            print("{:>7} {:>7} {:>5} {:>4}  {:<22} {:>10.2f}".format(
+                n, density, ndays, k, name, ms))
+            results.append({"step": name, "events": n, "density": density,
+                            "days": ndays, "participants": k, "ms": ms})
+    return results
+
+def suite_report(results):
+    """The results of run_suite, with where and when they were timed"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         stderr=subprocess.DEVNULL)
+        commit = commit.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results}
+
+def compare(results, baseline):
+    """Print each result's time as a ratio to the same step and
+    parameters in a baseline report (> 1 is slower now)"""
+    def key(result):
+        return (result["step"], result["events"], result["density"],
+                result["days"], result["participants"])
+    before = { key(result): result["ms"] for result in baseline["results"] }
+    print("Compared with {}".format(baseline.get("commit")))
+    print("{:<22} {:>7} {:>7} {:>5} {:>4} {:>10} {:>10} {:>7}".format(
+        "step", "events", "density", "days", "k", "before", "now", "ratio"))
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        print("{:<22} {:>7} {:>7} {:>5} {:>4} {:>10.2f} {:>10.2f} {:>7.2f}".format(
+            result["step"], result["events"], result["density"], result["days"],
+            result["participants"], old, result["ms"], result["ms"] / old if old else 0))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for agenda.py")
+    parser.add_argument("--suite", action="store_true",
+                        help="run only the suite")
+    parser.add_argument("--json", metavar="FILE",
+                        help="save the suite's results as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the suite's results with saved ones")
+    args = parser.parse_args(argv)
+    if not args.suite:
+        bench_intersect()
+        bench_intersect_all()
+        bench_arrays()
+        bench_probes()
+        bench_availability()
+        bench_parse()
+        bench_isotime()
+        bench_codec()
+    results = run_suite()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(suite_report(results), f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Compact encoding of session data.
+
+   The big values in a session are lists of the same few shapes:
+   the events of the events page (dicts of kind, id, summary, start,
+   end and show, see flask_main.format_events) and the free and busy
+   schedules (a list per day of dicts of descr, start and end, see
+   flask_main.sessionify).  As JSON every one of them repeats its
+   keys, and spells out two ISO timestamps of 19 to 25 characters.
+
+   dumps() packs such lists into columns of 32-bit integers instead:
+   times as wall-clock minutes since EPOCH, each start as the change
+   from the previous start and each end as a duration, and strings
+   (descriptions, ids, and the offset suffixes of the timestamps, like
+   "-08:00") as indexes into one table of distinct strings.  Anything
+   else in the session, and any list whose timestamps would not come
+   back as exactly the same text, is kept as JSON.  The result is
+   zlib-compressed, which the small, repetitive integers suit well.
+
+   loads(dumps(session)) == session for any session of JSON values.
+   The module itself has dumps and loads, so it can be given as the
+   serializer of a sessions.ServerSessionInterface.
+"""
+
+import array
+import datetime
+import json
+import re
+import struct
+import sys
+import zlib
+
+MAGIC = b"SC1"
+_RAW = b"r"
+_ZLIB = b"z"
+
+_ORD0 = datetime.date(1970, 1, 1).toordinal()
+_MINUTES_PER_DAY = 24 * 60
+_TIMESTAMP = re.compile(r"(\d{4}-\d\d-\d\d)T([01]\d|2[0-3]):([0-5]\d):00(Z|[+-]\d\d:\d\d)?$")
+_LENGTH = struct.Struct("<I")
+_INT_MAX = 2 ** 31 - 1     # Columns are 32-bit
+
+# The keys of the dicts packed as events and as schedule blocks
+EVENT_KEYS = frozenset(("kind", "id", "summary", "start", "end", "show"))
+BLOCK_KEYS = frozenset(("descr", "start", "end"))
+
+class _Strings:
+    """A table of distinct strings, each with its index"""
+
+    def __init__(self):
+        self.table = [ ]
+        self.index = { }
+
+    def __call__(self, text):
+        found = self.index.get(text)
+        if found is None:
+            found = self.index[text] = len(self.table)
+            self.table.append(text)
+        return found
+
+_days = { }     # ISO date text -> days since EPOCH (False if no such day)
+
+def _minutes(text):
+    """Wall-clock minutes since EPOCH and offset suffix of an ISO
+    timestamp, or None if _timestamp wouldn't give back the same text"""
+    if type(text) is not str:
+        return None
+    match = _TIMESTAMP.match(text)
+    if match is None:
+        return None
+    date, hour, minute, suffix = match.groups()
+    day = _days.get(date)
+    if day is None:
+        if len(_days) > 100000:
+            _days.clear()
+        try:
+            day = datetime.date(int(date[:4]), int(date[5:7]), int(date[8:])).toordinal() - _ORD0
+        except ValueError:
+            day = False
+        _days[date] = day
+    if day is False:
+        return None
+    return day * _MINUTES_PER_DAY + int(hour) * 60 + int(minute), suffix or ""
+
+_dates = { }    # Days since EPOCH -> ISO date text, for _timestamp
+
+def _timestamp(minutes, suffix):
+    """ISO text of wall-clock minutes since EPOCH and an offset suffix"""
+    day, minute = divmod(minutes, _MINUTES_PER_DAY)
+    date = _dates.get(day)
+    if date is None:
+        if len(_dates) > 100000:
+            _dates.clear()
+        date = _dates[day] = datetime.date.fromordinal(day + _ORD0).isoformat()
+    return "{}T{:02d}:{:02d}:00{}".format(date, minute // 60, minute % 60, suffix)
+
+def _pack_times(rows, columns, strings):
+    """Add the start and end of each row to the columns: start as a
+    change from the last, end as a duration, and both suffixes.
+    Returns False if a timestamp can't be packed."""
+    starts, durations, start_zones, end_zones = columns
+    last = 0
+    for row in rows:
+        start = _minutes(row["start"])
+        end = _minutes(row["end"])
+        if start is None or end is None:
+            return False
+        delta = start[0] - last
+        duration = end[0] - start[0]
+        if abs(delta) > _INT_MAX or abs(duration) > _INT_MAX:
+            return False
+        starts.append(delta)
+        durations.append(duration)
+        start_zones.append(strings(start[1]))
+        end_zones.append(strings(end[1]))
+        last = start[0]
+    return True
+
+def _unpack_times(columns, table):
+    """The (start, end) texts packed by _pack_times"""
+    starts, durations, start_zones, end_zones = columns
+    times = [ ]
+    minutes = 0
+    for delta, duration, start_zone, end_zone in zip(starts, durations,
+                                                    start_zones, end_zones):
+        minutes += delta
+        times.append((_timestamp(minutes, table[start_zone]),
+                      _timestamp(minutes + duration, table[end_zone])))
+    return times
+
+def _pack_events(value, strings):
+    """Columns for a list of events, or None if it isn't one"""
+    if not isinstance(value, list) or not value:
+        return None
+    kinds, ids, summaries, shows = [ ], [ ], [ ], [ ]
+    for e in value:
+        if (not isinstance(e, dict) or e.keys() != EVENT_KEYS
+                or type(e["show"]) is not bool
+                or not all(type(e[k]) is str for k in ("kind", "id", "summary"))):
+            return None
+        kinds.append(strings(e["kind"]))
+        ids.append(strings(e["id"]))
+        summaries.append(strings(e["summary"]))
+        shows.append(int(e["show"]))
+    times = ([ ], [ ], [ ], [ ])
+    if not _pack_times(value, times, strings):
+        return None
+    return [kinds, ids, summaries, shows] + list(times)
+
+def _unpack_events(columns, table):
+    kinds, ids, summaries, shows = columns[:4]
+    times = _unpack_times(columns[4:], table)
+    return [ {"kind": table[kind], "id": table[i], "summary": table[summary],
+              "start": start, "end": end, "show": bool(show)}
+             for kind, i, summary, show, (start, end)
+             in zip(kinds, ids, summaries, shows, times) ]
+
+def _pack_schedule(value, strings):
+    """Columns for a list of days of blocks, or None if it isn't one"""
+    if not isinstance(value, list) or not value:
+        return None
+    counts, descs, blocks = [ ], [ ], [ ]
+    for day in value:
+        if not isinstance(day, list):
+            return None
+        for block in day:
+            if (not isinstance(block, dict) or block.keys() != BLOCK_KEYS
+                    or type(block["descr"]) is not str):
+                return None
+            descs.append(strings(block["descr"]))
+        counts.append(len(day))
+        blocks.extend(day)
+    times = ([ ], [ ], [ ], [ ])
+    if not _pack_times(blocks, times, strings):
+        return None
+    return [counts, descs] + list(times)
+
+def _unpack_schedule(columns, table):
+    counts, descs = columns[:2]
+    times = _unpack_times(columns[2:], table)
+    blocks = [ {"descr": table[desc], "start": start, "end": end}
+               for desc, (start, end) in zip(descs, times) ]
+    schedule = [ ]
+    first = 0
+    for count in counts:
+        schedule.append(blocks[first:first + count])
+        first += count
+    return schedule
+
+_PACKERS = [ ("events", _pack_events), ("schedule", _pack_schedule) ]
+_UNPACKERS = { "events": _unpack_events, "schedule": _unpack_schedule }
+
+def dumps(data, compress=True):
+    """
+    Encode a session.
+
+    Arguments:
+        data: A dict of JSON values
+        compress: zlib-compress the encoding
+    Returns:
+        bytes for loads
+    """
+    strings = _Strings()
+    plain = { }
+    packed = [ ]      # [key, shape, column lengths]
+    columns = array.array("i")
+    for key, value in data.items():
+        for shape, pack in _PACKERS:
+            found = pack(value, strings)
+            if found is not None:
+                packed.append([key, shape, [len(column) for column in found]])
+                for column in found:
+                    columns.extend(column)
+                break
+        else:
+            plain[key] = value
+    if sys.byteorder != "little":
+        columns.byteswap()
+    meta = json.dumps([plain, strings.table, packed],
+                      separators=(",", ":")).encode("utf-8")
+    body = _LENGTH.pack(len(meta)) + meta + columns.tobytes()
+    if compress:
+        return MAGIC + _ZLIB + zlib.compress(body)
+    return MAGIC + _RAW + body
+
+def loads(blob):
+    """
+    Decode a session encoded by dumps.
+
+    Raises:
+        ValueError if blob isn't from dumps
+    """
+    if blob[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not an encoded session")
+    kind = blob[len(MAGIC):len(MAGIC) + 1]
+    body = blob[len(MAGIC) + 1:]
+    if kind == _ZLIB:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as err:
+            raise ValueError(str(err))
+    elif kind != _RAW:
+        raise ValueError("Not an encoded session")
+    if len(body) < _LENGTH.size:
+        raise ValueError("Not an encoded session")
+    length, = _LENGTH.unpack_from(body)
+    start = _LENGTH.size
+    plain, table, packed = json.loads(body[start:start + length].decode("utf-8"))
+    columns = array.array("i")
+    columns.frombytes(body[start + length:])
+    if sys.byteorder != "little":
+        columns.byteswap()
+
+    data = plain
+    position = 0
+    for key, shape, lengths in packed:
+        value_columns = [ ]
+        for n in lengths:
+            value_columns.append(columns[position:position + n])
+            position += n
+        data[key] = _UNPACKERS[shape](value_columns, table)
+    return data
@@ -0,0 +1,231 @@
+"""Cache of Google calendar events between visits.
+
+   Listing every event of every selected calendar on each visit to
+   /display is most of the time a request spends waiting.  Google can
+   tell us what changed instead: the last page of a full events().list
+   carries a nextSyncToken, and a later request with that syncToken
+   returns only the events added, changed or cancelled since.  A cache
+   here remembers, for each (user, calendar id), the calendar's events
+   by id and the latest sync token (see flask_main.sync_calendar).
+
+   Entries expire after a time to live, since Google's sync tokens
+   don't last forever either, and the least recently used entries are
+   evicted to keep the cache under a size cap.  MemoryCache keeps its
+   entries in this process (the default); DiskCache keeps them in
+   files under a directory, so they outlive the process and can be
+   shared by several worker processes.
+"""
+
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+# Default time to live of an entry, in seconds
+TTL = 7 * 24 * 3600
+
+class CacheEntry:
+    """The cached events of one calendar"""
+    __slots__ = ("events", "sync_token", "synced", "since", "until")
+
+    def __init__(self, events, sync_token, synced=None, since=None, until=None):
+        """
+        Arguments:
+            events: dict from event id to event resource.  Entries are
+                shared between threads, so callers must not change it
+                after putting the entry in a cache.
+            sync_token: Google's nextSyncToken for the listing, or None
+            synced: time.time() of the listing; now if not given
+            since: ISO date-time the listing began at (its timeMin),
+                or None if it holds the whole calendar
+            until: ISO date-time after which events were left out,
+                or None if none were
+        """
+        self.events = events
+        self.sync_token = sync_token
+        self.synced = time.time() if synced is None else synced
+        self.since = since
+        self.until = until
+
+    def __len__(self):
+        return len(self.events)
+
+class MemoryCache:
+    """Cache entries in a dict, in least recently used order.
+    Safe to share between threads."""
+
+    def __init__(self, ttl=TTL, max_events=100000):
+        """
+        Arguments:
+            ttl: Seconds after which an entry is no longer returned
+            max_events: Size cap, as the total number of events in all
+                entries; least recently used entries are evicted to
+                stay under it.
+        """
+        self.ttl = ttl
+        self.max_events = max_events
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The entry for key, or None if there is none or it has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.synced > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        """Store entry under key, replacing any entry there, and evict
+        the least recently used others while over the size cap."""
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._size += len(entry)
+            while self._size > self.max_events and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def discard(self, key):
+        """Forget the entry for key, if any"""
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskCache:
+    """Cache entries as pickle files in a directory, one per key.
+    The modification time of a file is when it was last used, for
+    least recently used eviction.  Files are replaced atomically, so
+    several threads or processes may share the directory."""
+
+    SUFFIX = ".events"
+
+    def __init__(self, directory, ttl=TTL, max_bytes=64 * 1024 * 1024):
+        """
+        Arguments:
+            directory: Where to keep the files; created if missing.
+                It should be private to the app, since the files hold
+                users' calendar events.
+            ttl: Seconds after which an entry is no longer returned
+            max_bytes: Size cap, as the total size of the files; least
+                recently used files are removed to stay under it.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + self.SUFFIX)
+
+    def get(self, key):
+        """The entry for key, or None if there is none or it has expired"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                stored_key, events, sync_token, synced, since, until = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        if stored_key != key:
+            return None
+        if time.time() - synced > self.ttl:
+            self.discard(key)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return CacheEntry(events, sync_token, synced, since, until)
+
+    def put(self, key, entry):
+        """Store entry under key, replacing any entry there, and evict
+        the least recently used others while over the size cap."""
+        path = self._path(key)
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((key, entry.events, entry.sync_token, entry.synced,
+                             entry.since, entry.until),
+                            f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        self._evict(keep=path)
+
+    def discard(self, key):
+        """Forget the entry for key, if any"""
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def _files(self):
+        """(mtime, size, path) of every cache file"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _evict(self, keep):
+        files = sorted(self._files())
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def __len__(self):
+        return len(self._files())
+
+def open_cache(backend="memory", directory=None, ttl=TTL):
+    """
+    Factory: A cache of the given backend.
+
+    Arguments:
+        backend: "memory", "disk" (which needs directory), or None
+            for no cache
+        directory: Where a disk cache keeps its files
+        ttl: Seconds an entry lasts
+    Returns:
+        A MemoryCache or DiskCache, or None
+    Raises:
+        ValueError if the backend is not one of these
+    """
+    if backend is None:
+        return None
+    if backend == "memory":
+        return MemoryCache(ttl)
+    if backend == "disk":
+        if directory is None:
+            raise ValueError("A disk event cache needs a directory")
+        return DiskCache(directory, ttl)
+    raise ValueError("Unknown event cache backend {}".format(backend))
@@ -8,6 +8,11 @@ import uuid
 
 import json
 import logging
+import heapq
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Date handling 
 import arrow # Replacement for datetime, based on moment.js
@@ -20,9 +25,19 @@ import httplib2   # used in oauth2 flow
 
 # Google API for services 
 from apiclient import discovery
+from apiclient.errors import HttpError
 
 # Our own modules
-from agenda import Appt, Agenda
+from agenda import Appt, Agenda, AgendaArray, HAVE_NUMPY
+from agenda import EPOCH, SECONDS_PER_DAY, day_number, epoch_seconds
+import isotime
+if HAVE_NUMPY:
+  import numpy as np
+import eventcache
+import httppool
+import sessions
+import metrics
+import profiling
 
 ###
 # Globals
@@ -40,10 +55,101 @@ app.debug=CONFIG.DEBUG
 app.logger.setLevel(logging.DEBUG)
 app.secret_key=CONFIG.secret_key
 
+# Sessions hold the events and schedules, too big for a cookie, so
+# they are kept on the server (see sessions). CONFIG.SESSION_BACKEND is
+# "memory" (the default), "file" or "sqlite" (stored at
+# CONFIG.SESSION_PATH), or "cookie" for Flask's own cookie sessions.
+_session_interface = sessions.open_session_interface(
+    getattr(CONFIG, "SESSION_BACKEND", "memory"),
+    getattr(CONFIG, "SESSION_PATH", None))
+if _session_interface is not None:
+  app.session_interface = _session_interface
+
 SCOPES = 'https://www.googleapis.com/auth/calendar.readonly'
 CLIENT_SECRET_FILE = secrets.admin_secrets.google_key_file  ## You'll need this
 APPLICATION_NAME = 'MeetMe class project'
 
+# The Calendar API's discovery document, read once per process (see
+# calendar_discovery). CONFIG.DISCOVERY_DOC may name a saved copy of it;
+# otherwise it is fetched from Google the first time it is needed.
+DISCOVERY_DOC = getattr(CONFIG, "DISCOVERY_DOC", None)
+_discovery = None
+_discovery_lock = threading.Lock()
+
+# Most calendars fetched from Google at the same time on /display
+FETCH_WORKERS = 8
+
+# The parts of each events().list response we use (see format_events);
+# Google leaves out everything else
+EVENT_FIELDS = "nextPageToken,items(id,kind,summary,start,end,transparency)"
+
+# The same for listings kept in the event cache, which also need the
+# sync token and which events were cancelled
+SYNC_FIELDS = ("nextPageToken,nextSyncToken,"
+               "items(id,kind,status,summary,start,end,transparency)")
+
+# Events of each user's calendars kept between visits (see eventcache).
+# CONFIG.EVENT_CACHE is "memory" (the default), "disk" (in the directory
+# CONFIG.EVENT_CACHE_DIR) or None for no cache.
+event_cache = eventcache.open_cache(getattr(CONFIG, "EVENT_CACHE", "memory"),
+                                    getattr(CONFIG, "EVENT_CACHE_DIR", None))
+
+# A calendar's first listing for the event cache goes back this many
+# days before the range asked for (or before today, if that is earlier),
+# rather than to the beginning of the calendar. Events starting more than
+# SYNC_FUTURE_DAYS after the range asked for (or after today) aren't kept,
+# so a recurring event with no end date doesn't fill the cache.
+SYNC_PAST_DAYS = 31
+SYNC_FUTURE_DAYS = 366
+
+# Http transports kept open between requests to Google (see httppool),
+# enough for a full set of fetch workers to share. At most HTTP_POOL_SIZE
+# are in use at once; a request that can't get one within
+# HTTP_POOL_TIMEOUT seconds is answered 503.
+HTTP_POOL_SIZE = getattr(CONFIG, "HTTP_POOL_SIZE", 4 * FETCH_WORKERS)
+HTTP_POOL_TIMEOUT = 10
+http_pool = httppool.HttpPool(max_idle=FETCH_WORKERS, max_size=HTTP_POOL_SIZE)
+
+# Timings and counts of what requests spend their time on, served on
+# /metrics when CONFIG.METRICS is true (see metrics)
+app_metrics = metrics.Registry(enabled=getattr(CONFIG, "METRICS", False),
+                               prefix="meetme_")
+request_seconds = app_metrics.histogram(
+  "request_seconds", "Time to handle a request", labels=("endpoint",))
+events_processed = app_metrics.counter(
+  "events_processed_total", "Google calendar events formatted")
+calendars_fetched = app_metrics.counter(
+  "calendars_fetched_total", "Calendars whose events were fetched")
+event_cache_lookups = app_metrics.counter(
+  "event_cache_lookups_total", "Event cache lookups, by result", labels=("result",))
+for _name in ("in_use", "idle", "created", "reused", "waited"):
+  app_metrics.gauge("http_pool_" + _name, "Http pool: " + _name.replace("_", " "),
+                    functools.partial(lambda name: http_pool.metrics()[name], _name))
+
+# Requests with a token signed with CONFIG.PROFILE_KEY (see profiling)
+# are profiled into CONFIG.PROFILE_DIR, if CONFIG.PROFILE is true
+profiler = None
+if getattr(CONFIG, "PROFILE", False):
+  profiler = profiling.Profiler(CONFIG.PROFILE_KEY,
+                                getattr(CONFIG, "PROFILE_DIR", "profiles"))
+
+# Longest date range /api/v1/freetimes will answer for
+API_MAX_DAYS = 366
+
+# Date ranges of at least this many days have their free and busy
+# times computed with the numpy-backed AgendaArray, if numpy is installed
+VECTORIZE_DAYS = 28
+
+# Batches of at least this many events are checked against the daily
+# time frame with numpy (see filter_time_frame), if it is installed
+VECTORIZE_EVENTS = 64
+
+# Most days of busy and free times remembered (see day_blocks)
+DAY_CACHE_SIZE = 4096
+
+# Most event start and end times remembered parsed (see event_epochs)
+EVENT_PARSE_CACHE_SIZE = 65536
+
 #############################
 #
 #  Pages (routed from URLs)
@@ -56,7 +162,7 @@ def index():
   app.logger.debug("Entering index")
   if 'begin_date' not in flask.session:
     init_session_values()
-  return render_template('index.html')
+  return render_page('index.html')
 
 @app.route("/choose")
 def choose():
@@ -73,7 +179,7 @@ def choose():
     gcal_service = get_gcal_service(credentials)
     app.logger.debug("Returned from get_gcal_service")
     flask.g.calendars = list_calendars(gcal_service)
-    return render_template('index.html')
+    return render_page('index.html')
 
 @app.route("/display", methods=['POST'])
 def displayEvents():
@@ -83,21 +189,50 @@ def displayEvents():
       app.logger.debug("Redirecting to authorization")
       return flask.redirect(flask.url_for('oauth2callback'))
 
-    gcal_service = get_gcal_service(credentials)
+    leases = request_leases()
+    if event_cache is not None and 'uid' not in flask.session:
+      flask.session['uid'] = google_user(credentials,
+                                         get_gcal_service(credentials, leases))
+    with app_metrics.span("google_fetch"):
+      sorted_events = fetch_events(lambda: get_gcal_service(credentials, leases),
+                                   list(request.form),
+                                   flask.session['begin_date'],
+                                   next_day(flask.session['end_date']),
+                                   flask.session['begin_time'],
+                                   flask.session['end_time'],
+                                   cache=event_cache,
+                                   user=flask.session.get('uid'))
+    flask.session['events'] = sorted_events
 
-    events = []
-    for selected in request.form:
-      response = gcal_service.events().list(
-                      calendarId=selected,
-                      timeMin=flask.session['begin_date'],
-                      timeMax=next_day(flask.session['end_date'])
-                      ).execute()["items"]
-      events = events + format_events(response)
+    return render_page('busytimes.html')
 
-    sorted_events = sorted(events, key=lambda e: e["start"])
-    flask.session['events'] = sorted_events
+@app.route("/freebusy", methods=['POST'])
+def displayFreebusy():
+    """
+    Free times straight from the selected calendars' busy times (one
+    freebusy request), skipping the page of individual events.
+    """
+    app.logger.debug("Entering displayFreebusy")
+    credentials = valid_credentials()
+    if not credentials:
+      app.logger.debug("Redirecting to authorization")
+      return flask.redirect(flask.url_for('oauth2callback'))
 
-    return render_template('busytimes.html')
+    gcal_service = get_gcal_service(credentials)
+    with app_metrics.span("google_fetch"):
+      appts = freebusy_appts(gcal_service, list(request.form),
+                             flask.session['begin_date'],
+                             next_day(flask.session['end_date']))
+    with app_metrics.span("busy_free_times"):
+      schedule = busy_free_times(bucket_appts(appts),
+                                 flask.session['begin_date'],
+                                 flask.session['end_date'],
+                                 flask.session['begin_time'],
+                                 flask.session['end_time'])
+
+    flask.session['free'] = sessionify(schedule['free'])
+    flask.session['busy'] = sessionify(schedule['busy'])
+    return render_page('freetimes.html')
 
 @app.route("/freetime", methods=['POST'])
 def displayFreetimes():
@@ -106,15 +241,19 @@ def displayFreetimes():
       app.logger.debug("Events not in session redirecting")
       return redirect(url_for('index'))
 
+    # Unticked events are dropped from the session, in one pass
+    excluded = set(request.form)
     events = flask.session['events']
-    for delkey in request.form:
-      events[:] = [d for d in events if d.get('id') != delkey]
-    
-    schedule = get_busy_free_times(flask.session['events'],
-                                    flask.session['begin_date'],
-                                    flask.session['end_date'], 
-                                    flask.session['begin_time'],
-                                    flask.session['end_time'])
+    if excluded:
+      events = [e for e in events if e.get('id') not in excluded]
+      flask.session['events'] = events
+
+    with app_metrics.span("busy_free_times"):
+      schedule = busy_free_days(bucket_events(events),
+                                flask.session['begin_date'],
+                                flask.session['end_date'],
+                                flask.session['begin_time'],
+                                flask.session['end_time'])
 
     #store in session, must be processed so it can go into session
     flask.session['free'] = sessionify(schedule['free'])
@@ -125,7 +264,235 @@ def displayFreetimes():
     #   for appt in day.appts:
     #     print("{} to {}\n".format(appt.start_isoformat(),appt.end_isoformat()))
 
-    return render_template('freetimes.html')
+    return render_page('freetimes.html')
+
+@app.route("/freetime/stream", methods=['POST'])
+def displayFreetimesStream():
+    """
+    Like /freetime, but the page shows each day's free times as they
+    arrive from /freetime/days instead of waiting for all of them
+    """
+    app.logger.debug("Entering displayFreetimesStream")
+    if 'events' not in flask.session:
+      return redirect(url_for('index'))
+    # Unticked events are dropped from the session, as on /freetime
+    excluded = set(request.form)
+    if excluded:
+      flask.session['events'] = [e for e in flask.session['events']
+                                 if e.get('id') not in excluded]
+    return render_page('freetimes_stream.html')
+
+@app.route("/freetime/days")
+def streamFreetimes():
+    """
+    Each day's busy and free times (see day_json) for the session's
+    events, sent as soon as each day is done: as server-sent events
+    if asked for with ?format=sse or an Accept of text/event-stream,
+    one JSON object per line (NDJSON) otherwise.
+
+    The events are all grouped by day (bucket_events) before the
+    first day is sent, since any of them may fall on it; so the time
+    to the first byte still grows with the number of events, though
+    not with the number of days. Events parsed on an earlier request
+    cost only a lookup there (see event_epochs).
+    """
+    if 'events' not in flask.session:
+      return json_response({"error": "No events in the session"}, 404)
+    days = iter_busy_free_times(bucket_events(flask.session['events']),
+                                flask.session['begin_date'],
+                                flask.session['end_date'],
+                                flask.session['begin_time'],
+                                flask.session['end_time'])
+
+    sse = (request.args.get('format') == 'sse' or
+           request.accept_mimetypes.best == 'text/event-stream')
+    def ndjson():
+      for date, busy, free in days:
+        yield json.dumps(day_json(date, busy, free), separators=(",", ":")) + "\n"
+    def server_sent_events():
+      for date, busy, free in days:
+        yield "event: day\ndata: {}\n\n".format(
+          json.dumps(day_json(date, busy, free), separators=(",", ":")))
+      yield "event: done\ndata: {}\n\n"
+
+    response = flask.Response(server_sent_events() if sse else ndjson(),
+                              mimetype="text/event-stream" if sse else "application/x-ndjson")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"   # Don't let nginx hold it back
+    return response
+
+def render_page(template):
+    """
+    render_template, timed as the "render" span
+    """
+    with app_metrics.span("render"):
+      return render_template(template)
+
+@app.route("/metrics")
+def show_metrics():
+    """
+    Metrics for Prometheus to scrape, if CONFIG.METRICS is on
+    """
+    if not app_metrics.enabled:
+      flask.abort(404)
+    return flask.Response(app_metrics.render(),
+                          mimetype="text/plain; version=0.0.4")
+
+@app.before_request
+def start_timer():
+    """Note when the request began, for request_seconds"""
+    if app_metrics.enabled:
+      flask.g.started = time.perf_counter()
+
+@app.teardown_request
+def stop_timer(exc=None):
+    """Record how long the request took"""
+    started = getattr(flask.g, 'started', None)
+    if started is not None:
+      request_seconds.observe(time.perf_counter() - started,
+                              endpoint=request.endpoint or "none")
+
+@app.before_request
+def start_profile():
+    """Profile this request, if profiling is on and it has a token"""
+    if profiler is not None and profiler.wanted(request):
+      flask.g.sampler = profiler.start()
+
+@app.teardown_request
+def finish_profile(exc=None):
+    """Write this request's profile to the spool"""
+    sampler = getattr(flask.g, 'sampler', None)
+    if sampler is not None:
+      path = profiler.finish(sampler, request.endpoint or "none")
+      app.logger.debug("Wrote profile {}".format(path))
+
+#####
+#
+#  JSON API: answers from the request alone, without the session
+#
+#####
+
+class APIError(Exception):
+    """A request to the API that can't be answered, with its HTTP status"""
+    def __init__(self, message, status=400):
+      Exception.__init__(self, message)
+      self.status = status
+
+@app.errorhandler(APIError)
+def api_error(err):
+    return json_response({"error": str(err)}, err.status)
+
+def json_response(data, status=200):
+    return flask.Response(json.dumps(data, separators=(",", ":")), status=status,
+                          mimetype="application/json")
+
+@app.route("/api/v1/freetimes", methods=['POST'])
+def api_freetimes():
+    """
+    Busy and free times for a JSON request like
+      {"begin_date": "2016-11-15", "end_date": "2016-11-21",
+       "begin_time": "09:00", "end_time": "17:00",
+       "busy": [{"start": "2016-11-15T10:00:00-08:00",
+                 "end": "2016-11-15T11:00:00-08:00", "summary": "Class"}],
+       "calendars": ["primary"]}
+    where busy (ISO date-times, in any time zone) and calendars (whose
+    busy times come from Google, with a bearer token in the
+    Authorization header or the session's credentials) may each be
+    left out. The answer has a "days" list, each day with its date
+    and its "busy" [begin, end, description] and "free" [begin, end]
+    blocks as local times of day, e.g.
+      {"days": [{"date": "2016-11-15",
+                 "busy": [["10:00", "11:00", "Class"]],
+                 "free": [["09:00", "10:00"], ["11:00", "17:00"]]}, ...]}
+    """
+    query = request.get_json(force=True, silent=True)
+    if not isinstance(query, dict):
+      raise APIError("The request must be a JSON object")
+    try:
+      first = datetime.datetime.strptime(query["begin_date"], "%Y-%m-%d")
+      last = datetime.datetime.strptime(query["end_date"], "%Y-%m-%d")
+      begin = datetime.datetime.strptime(query["begin_time"], "%H:%M").time()
+      end = datetime.datetime.strptime(query["end_time"], "%H:%M").time()
+    except KeyError as err:
+      raise APIError("Missing {}".format(err))
+    except (ValueError, TypeError) as err:
+      raise APIError("Bad request: {}".format(err))
+    if not first <= last <= first + datetime.timedelta(days=API_MAX_DAYS - 1):
+      raise APIError("The date range must be 1 to {} days".format(API_MAX_DAYS))
+    if not begin < end:
+      raise APIError("end_time must be after begin_time")
+
+    # Busy blocks are cut to the days asked for before they are split
+    # into days, however long they are
+    local = tz.tzlocal()
+    range_min = first.replace(tzinfo=local)
+    range_max = (last + datetime.timedelta(days=1)).replace(tzinfo=local)
+    busy = query.get("busy", [])
+    if not isinstance(busy, list):
+      raise APIError("busy must be a list")
+    try:
+      appts = []
+      for block in busy:
+        appts.extend(local_appts(block["start"], block["end"],
+                                 block.get("summary", "Busy"),
+                                 range_min, range_max))
+    except KeyError as err:
+      raise APIError("Missing {} in busy".format(err))
+    except (ValueError, TypeError, AttributeError, OverflowError) as err:
+      raise APIError("Bad request: {}".format(err))
+
+    calendars = query.get("calendars", [])
+    if (not isinstance(calendars, list) or
+        not all(isinstance(calendar_id, str) for calendar_id in calendars)):
+      raise APIError("calendars must be a list of calendar ids")
+    if calendars:
+      credentials = api_credentials()
+      if not credentials:
+        raise APIError("Calendars need Google authorization", 401)
+      try:
+        with app_metrics.span("google_fetch"):
+          appts.extend(freebusy_appts(get_gcal_service(credentials), calendars,
+                                      range_min.isoformat(), range_max.isoformat()))
+      except HttpError as err:
+        if err.resp.status in (401, 403):
+          raise APIError("Google refused the authorization", 401)
+        raise APIError("Google calendar request failed ({})".format(err.resp.status), 502)
+
+    with app_metrics.span("busy_free_times"):
+      schedule = busy_free_times(bucket_appts(appts),
+                                 first.isoformat(), last.isoformat(),
+                                 datetime.datetime.combine(first, begin).isoformat(),
+                                 datetime.datetime.combine(first, end).isoformat())
+    days = [day_json(first.date() + datetime.timedelta(days=n), busy, free)
+            for n, (busy, free) in enumerate(zip(schedule["busy"], schedule["free"]))]
+    return json_response({"days": days})
+
+def day_json(date, busy, free):
+    """
+    One day's busy and free Agendas as a dict for JSON: its date, and
+    its "busy" [begin, end, description] and "free" [begin, end] blocks
+    """
+    return {"date": date.isoformat(),
+            "busy": [block_times(appt) + [appt.desc] for appt in busy],
+            "free": [block_times(appt) for appt in free]}
+
+def block_times(appt):
+    """The [begin, end] local times of day of an Appt, as "HH:MM"
+    (an end at midnight is "24:00")"""
+    midnight = appt.begin_epoch // SECONDS_PER_DAY * SECONDS_PER_DAY
+    return ["{:02d}:{:02d}".format(*divmod((t - midnight) // 60, 60))
+            for t in (appt.begin_epoch, appt.end_epoch)]
+
+def api_credentials():
+    """
+    Credentials for the API: a bearer token in the Authorization
+    header, or else the session's, or None
+    """
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+      return client.AccessTokenCredentials(auth[len("Bearer "):], APPLICATION_NAME)
+    return valid_credentials()
+
 #####
 #
 #  Option setting:  Buttons or forms that add some
@@ -243,21 +610,33 @@ def combine_date_time(arw_date, arw_time):
     output = datetime.datetime.combine(arw_date.date(),arw_time.time())
     return output.replace(tzinfo=tz.tzlocal()).isoformat()
 
+def parse_iso(isotext):
+    """
+    ISO date-time text as an aware datetime, through the cached fast
+    parser in isotime. Like arrow.get, text without an offset is UTC.
+    """
+    parsed = isotime.parse(isotext)
+    if parsed.tzinfo is None:
+      parsed = parsed.replace(tzinfo=tz.tzutc())
+    return parsed
+
+def local_time(isotext):
+    """
+    Local time of day (datetime.time) of ISO date-time text
+    """
+    return parse_iso(isotext).astimezone(tz.tzlocal()).time()
+
 def next_day(isotext):
     """
     ISO date + 1 day (used in query to Google calendar)
     """
-    as_arrow = arrow.get(isotext)
-    return as_arrow.replace(days=+1).isoformat()
+    return (parse_iso(isotext) + datetime.timedelta(days=1)).isoformat()
 
 def same_date(x,y):
     """
     Takes two isoformated datetime objects and determines if they are the same date
     """
-    x_arw = arrow.get(x)
-    y_arw = arrow.get(y)
-
-    return x_arw.date() == y_arw.date()
+    return parse_iso(x).date() == parse_iso(y).date()
   
 def list_calendars(service):
     """
@@ -292,41 +671,271 @@ def list_calendars(service):
             })
     return sorted(result, key=cal_sort_key)
 
-def format_events(events):
+def format_events(events, lowerbound=None, upperbound=None):
     """
-    Given a google 'service' object, return a list of
-    calendars.  Each calendar is represented by a dict.
-    The returned list is sorted to have
-    the primary calendar first, and selected (that is, displayed in
-    Google Calendars web app) calendars before unselected calendars.
+    Given a list of google calendar events, return the ones that
+    block time between the times of day lowerbound and upperbound
+    (by default the session's begin_time and end_time), each as a
+    dict with the fields we use.
     """
     app.logger.debug("Entering format_events")
-    result = [ ]
+    with app_metrics.span("format_events"):
+      return _format_events(events, lowerbound, upperbound)
+
+def _format_events(events, lowerbound, upperbound):
+    if lowerbound is None:
+      lowerbound = flask.session['begin_time']
+    if upperbound is None:
+      upperbound = flask.session['end_time']
+    shown = [ ]
+    starts = [ ]
+    ends = [ ]
     for e in events:
+        if("transparency" in e):
+          continue
         if("date" in e["start"]):
           start = interpret_date(e["start"]["date"],"YYYY-MM-DD")
           end = interpret_date(e["end"]["date"],"YYYY-MM-DD")
         else:
           start = e["start"]["dateTime"]
           end = e["end"]["dateTime"]
+        shown.append(e)
+        starts.append(start)
+        ends.append(end)
 
-        if("transparency" in e):
-          show = False
-        else:
-          show = True
-
-        if(show and in_time_frame(start,end,flask.session['begin_time'],flask.session['end_time'])):
+    events_processed.inc(len(shown))
+    result = [ ]
+    in_frame = filter_time_frame(starts, ends, lowerbound, upperbound)
+    for e, start, end, keep in zip(shown, starts, ends, in_frame):
+        if keep:
           result.append(
             { "kind": e["kind"],
               "id": e["id"],
               "summary": e["summary"],
               "start": start,
               "end": end,
-              "show": show
+              "show": True
               })
 
     return result
 
+def fetch_events(make_service, calendar_ids, time_min, time_max,
+                 lowerbound, upperbound, workers=FETCH_WORKERS,
+                 cache=None, user=None):
+    """
+    Fetch and format (see format_events) the events of several
+    calendars from time_min to time_max, with up to 'workers'
+    calendars fetched at once. make_service is called in each
+    worker thread for a calendar 'service' object of its own, since
+    the http objects under them aren't thread safe. Each calendar
+    is read a page at a time, and each page is formatted as it
+    arrives. With a cache (see eventcache), each calendar is
+    instead brought up to date there for user (see sync_calendar)
+    and its events in the range taken from that. Returns one list
+    of events sorted by start.
+    """
+    def fetch(calendar_id):
+      service = make_service()
+      calendars_fetched.inc()
+      if cache is not None:
+        first = parse_iso(time_min)
+        last = parse_iso(time_max)
+        synced = sync_calendar(service, cache, user, calendar_id, time_min, time_max)
+        in_range = [e for e in synced.values()
+                    if event_time(e["start"]) < last and event_time(e["end"]) > first]
+        return sorted(format_events(in_range, lowerbound, upperbound),
+                      key=lambda e: e["start"])
+      events = []
+      for page in iter_event_pages(service, calendar_id,
+                                   timeMin=time_min,
+                                   timeMax=time_max,
+                                   singleEvents=True,
+                                   orderBy="startTime",
+                                   fields=EVENT_FIELDS):
+        events.extend(format_events(page.get("items", []), lowerbound, upperbound))
+      # Google sends them in order of start time already; sorting by
+      # our start strings is then a single cheap pass
+      return sorted(events, key=lambda e: e["start"])
+
+    if len(calendar_ids) <= 1:
+      fetched = [fetch(calendar_id) for calendar_id in calendar_ids]
+    else:
+      with ThreadPoolExecutor(max_workers=min(workers, len(calendar_ids))) as pool:
+        fetched = list(pool.map(fetch, calendar_ids))
+    return merge_events(fetched)
+
+def sync_calendar(service, cache, user, calendar_id, time_min=None, time_max=None):
+    """
+    The events of one calendar starting from a while before time_min
+    to a while after time_max (see sync_window), as a dict from
+    event id to the event resource, kept up to date in cache under
+    (user, calendar_id). The first time, once the entry has expired,
+    or when time_min to time_max isn't all within the window the
+    entry was listed for, the calendar is listed for a new window.
+    After that Google is asked only for changes since the sync token
+    saved with the events; if it says the token is no longer good
+    (410 Gone) the calendar is listed again.
+
+    Google won't take timeMax or orderBy with a sync token, so
+    listings aren't limited at the end of the window; events starting
+    after it are dropped as they arrive instead. Google still sends
+    the instances of recurring events with no end date, as far ahead
+    as it expands them, but only the first listing pages through them;
+    the later ones carry only what changed.
+    """
+    key = (user, calendar_id)
+    entry = cache.get(key)
+    event_cache_lookups.inc(result="hit" if entry is not None else "miss")
+    now = datetime.datetime.now(tz.tzutc())
+    first = parse_iso(time_min) if time_min else now
+    last = parse_iso(time_max) if time_max else now
+    if entry is not None and entry.since is not None and first < parse_iso(entry.since):
+      entry = None
+    if entry is not None and entry.until is not None and last > parse_iso(entry.until):
+      entry = None
+    if entry is not None and entry.sync_token:
+      events = dict(entry.events)
+      try:
+        token = apply_event_pages(events, iter_event_pages(
+          service, calendar_id, singleEvents=True,
+          syncToken=entry.sync_token, fields=SYNC_FIELDS), entry.until)
+      except HttpError as err:
+        if err.resp.status != 410:
+          raise
+        app.logger.debug("Sync token for {} expired".format(calendar_id))
+      else:
+        cache.put(key, eventcache.CacheEntry(events, token, since=entry.since,
+                                             until=entry.until))
+        return events
+
+    events = {}
+    since, until = sync_window(time_min, time_max)
+    token = apply_event_pages(events, iter_event_pages(
+      service, calendar_id, singleEvents=True, timeMin=since, fields=SYNC_FIELDS), until)
+    cache.put(key, eventcache.CacheEntry(events, token, since=since, until=until))
+    return events
+
+def sync_window(time_min=None, time_max=None):
+    """
+    The (since, until) ISO date-times of a listing for the event
+    cache: SYNC_PAST_DAYS before time_min, or before now if that is
+    earlier, to SYNC_FUTURE_DAYS after time_max, or after now if
+    that is later
+    """
+    now = datetime.datetime.now(tz.tzutc())
+    first = min(now, parse_iso(time_min)) if time_min else now
+    last = max(now, parse_iso(time_max)) if time_max else now
+    return ((first - datetime.timedelta(days=SYNC_PAST_DAYS)).isoformat(),
+            (last + datetime.timedelta(days=SYNC_FUTURE_DAYS)).isoformat())
+
+def google_user(credentials, service):
+    """
+    A name for the Google account credentials are for that stays the
+    same between logins, to key its cached events by: the subject of
+    the id token if Google sent one, else the id of the account's
+    primary calendar (its email address)
+    """
+    id_token = getattr(credentials, "id_token", None) or {}
+    if id_token.get("sub"):
+      return id_token["sub"]
+    return service.calendars().get(calendarId="primary", fields="id").execute()["id"]
+
+def apply_event_pages(events, pages, until=None):
+    """
+    Apply the pages of an events().list listing to a dict from
+    event id to event: cancelled events, and events starting at or
+    after ISO date-time until (if given), are removed, the others
+    added or replaced. Returns the nextSyncToken of the last page.
+    """
+    last = parse_iso(until) if until else None
+    token = None
+    for page in pages:
+      for e in page.get("items", []):
+        if (e.get("status") == "cancelled" or
+            last is not None and event_time(e["start"]) >= last):
+          events.pop(e["id"], None)
+        else:
+          events[e["id"]] = e
+      token = page.get("nextSyncToken", token)
+    return token
+
+def event_time(when):
+    """
+    The start or end of an event resource as an aware datetime; the
+    "date" of an all-day event is midnight local time
+    """
+    if "date" in when:
+      return isotime.parse(when["date"]).replace(tzinfo=tz.tzlocal())
+    return parse_iso(when["dateTime"])
+
+def freebusy_appts(service, calendar_ids, time_min, time_max):
+    """
+    The busy times of several calendars from time_min to time_max,
+    from one freebusy().query request instead of listing their events.
+    Busy blocks are in local time, split at midnight into one Appt
+    per day. Returns a list of Appt described as "Busy".
+    """
+    response = service.freebusy().query(body={
+      "timeMin": time_min,
+      "timeMax": time_max,
+      "items": [{"id": calendar_id} for calendar_id in calendar_ids]
+      }).execute()
+
+    appts = []
+    for calendar_id, calendar in response.get("calendars", {}).items():
+      if "errors" in calendar:
+        app.logger.debug("Freebusy errors for {}: {}".format(
+          calendar_id, calendar["errors"]))
+      for block in calendar.get("busy", []):
+        appts.extend(local_appts(block["start"], block["end"], "Busy"))
+    return appts
+
+def local_appts(start, end, desc, lower=None, upper=None):
+    """
+    The time from ISO date-times start to end, in local time, as
+    Appts split at midnight (one per day it touches). If given, the
+    aware datetimes lower and upper cut the time down to their range
+    first.
+    """
+    begin = parse_iso(start)
+    finish = parse_iso(end)
+    if lower is not None and begin < lower:
+      begin = lower
+    if upper is not None and finish > upper:
+      finish = upper
+    begin = begin.astimezone(tz.tzlocal())
+    finish = finish.astimezone(tz.tzlocal())
+    begin = epoch_seconds(begin, begin)
+    finish = epoch_seconds(finish, finish)
+    appts = []
+    while begin < finish:
+      midnight = (begin // SECONDS_PER_DAY + 1) * SECONDS_PER_DAY
+      appts.append(Appt.from_epoch(begin, min(finish, midnight), desc))
+      begin = midnight
+    return appts
+
+def iter_event_pages(service, calendar_id, **params):
+    """
+    Generator: the response pages of an events().list request for
+    one calendar, following nextPageToken until the last page.
+    params are passed on to events().list.
+    """
+    while True:
+      page = service.events().list(calendarId=calendar_id, **params).execute()
+      yield page
+      if not page.get("nextPageToken"):
+        return
+      params["pageToken"] = page["nextPageToken"]
+
+def merge_events(event_lists):
+    """
+    Merge lists of events, each sorted by start, into one sorted list
+    (a k-way merge, rather than concatenating and sorting again).
+    """
+    decorated = [[(e["start"], k, n, e) for n, e in enumerate(events)]
+                 for k, events in enumerate(event_lists)]
+    return [e for start, k, n, e in heapq.merge(*decorated)]
+
 def in_time_frame(startTime, endTime, lowerbound, upperbound):
     """
     This function takes a time frame and compares to established
@@ -335,71 +944,228 @@ def in_time_frame(startTime, endTime, lowerbound, upperbound):
     dates in the range and we now filter down to the times that 
     matter.
     """
+    return filter_time_frame([startTime], [endTime], lowerbound, upperbound)[0]
 
-    arw_lowerbound = arrow.get(lowerbound).to('local').time()
-    arw_upperbound = arrow.get(upperbound).to('local').time()
-    start = arrow.get(startTime).to('local').time()
-    end = arrow.get(endTime).to('local').time()
-    retval = False
+def filter_time_frame(starts, ends, lowerbound, upperbound):
+    """
+    in_time_frame for many events at once: the bounds are read once,
+    and each start and end once, as local times of day. Returns a
+    list of booleans, one per event.
+
+    An event meets the time frame if it starts at or before the
+    frame's end and ends at or after the frame's start. That is what
+    in_time_frame's four cases add up to, as long as the event ends
+    after it starts and the frame does too; when either wraps past
+    midnight, the four cases are checked as they always were.
+    """
+    lb = time_of_day(local_time(lowerbound))
+    ub = time_of_day(local_time(upperbound))
+    s = [time_of_day(local_time(start)) for start in starts]
+    e = [time_of_day(local_time(end)) for end in ends]
+
+    if HAVE_NUMPY and len(s) >= VECTORIZE_EVENTS:
+      s = np.array(s, dtype=np.int64)
+      e = np.array(e, dtype=np.int64)
+      meets = (s <= ub) & (e >= lb)
+      if lb > ub or np.any(e < s):
+        legacy = (((s <= lb) & (e >= lb)) | ((s >= lb) & (e <= ub)) |
+                  ((s <= ub) & (e >= ub)) | ((s <= lb) & (e >= ub)))
+        meets = np.where((e < s) | (lb > ub), legacy, meets)
+      return meets.tolist()
 
-    if(start <= arw_lowerbound and end >= arw_lowerbound): #event starts before time-frame but ends after time-frame start
-        retval = True
+    result = [ ]
+    for start, end in zip(s, e):
+      if start <= end and lb <= ub:
+        result.append(start <= ub and end >= lb)
+      else:
+        result.append((start <= lb and end >= lb) or   # Starts before the frame, ends in or after it
+                      (start >= lb and end <= ub) or    # Inside the frame
+                      (start <= ub and end >= ub) or    # Starts by the frame's end, continues past it
+                      (start <= lb and end >= ub))      # Covers the frame
+    return result
 
-    if(start >= arw_lowerbound and end <= arw_upperbound): #event starts and ends inside the time-frame
-        retval = True
+def time_of_day(t):
+    """A datetime.time as microseconds since midnight"""
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1000000 + t.microsecond
 
-    if(start <= arw_upperbound and end >= arw_upperbound): #event starts before end of time-frame and continues past it
-        retval = True
+def get_busy_free_times(events, dStart, dEnd, tStart, tEnd, vectorized=None):
+    """
+    Busy and free times for each day from dStart to dEnd, within
+    the daily window from tStart to tEnd. Returns a dict with lists
+    "busy" and "free" of one Agenda per day.
+    """
+    return busy_free_times(bucket_events(events), dStart, dEnd, tStart, tEnd,
+                           vectorized)
 
-    if(start <= arw_lowerbound and end >= arw_upperbound): #event completely overlapse the time-frame
-        retval = True
-          
-    return retval
+def busy_free_times(buckets, dStart, dEnd, tStart, tEnd, vectorized=None):
+    """
+    get_busy_free_times for busy Appts already grouped by day (see
+    bucket_appts), from a single Agenda.complement_range over them.
+    vectorized chooses busy_free_arrays for the work instead; by
+    default it is used for ranges of VECTORIZE_DAYS or more.
+    """
+    if vectorized is None:
+      ndays = (parse_iso(dEnd) - parse_iso(dStart)).days
+      vectorized = HAVE_NUMPY and ndays >= VECTORIZE_DAYS
+    if vectorized:
+      return busy_free_arrays(buckets, dStart, dEnd, tStart, tEnd)
+
+    first = parse_iso(dStart).date()
+    last = parse_iso(dEnd).date()
+    busy = Agenda()
+    busy.appts = events_in_range(buckets, first, last)
+
+    #one sweep over the whole range gives each day's busy and free times
+    busytimes, freetimes = busy.complement_range(first, last,
+                                                 parse_iso(tStart).time(),
+                                                 parse_iso(tEnd).time(),
+                                                 "Free Time")
+    return {"busy":busytimes, "free":freetimes}
 
-def get_busy_free_times(events, dStart, dEnd, tStart, tEnd):
+def busy_free_days(buckets, dStart, dEnd, tStart, tEnd):
+    """
+    busy_free_times worked out a day at a time by day_busy_free,
+    which remembers each day's answer. When only a few days' events
+    change, as when events are unticked on /freetime, only those
+    days are worked out again.
+
+    This doesn't go through busy_free_times' whole-range ways
+    (complement_range over all days, or AgendaArray for long
+    ranges): those would work out every day again on each visit to
+    /freetime, where a remembered day costs only a lookup. They
+    still serve /freebusy and the JSON API, which have no days to
+    remember.
+    """
     busytimes = []
     freetimes = []
-    
-    count = len(events)
-    begin = arrow.get(dStart)
-    end = arrow.get(dEnd)
-    time_begin = combine_date_time(begin, arrow.get(tStart))
-    time_end = combine_date_time(begin, arrow.get(tEnd))
-    i = 0
-
-    for day in arrow.Arrow.range('day',begin,end):
-      busytimes_today = Agenda()
-      
-      for e in events[i:]:
-        if same_date(day.isoformat(), e['start']):
-          busytimes_today.append(Appt.from_iso_date(e['start'],e['end'],e['summary']))
-          i = i+1
-
-      #we have all busy times for a single day now
-      #lets generate free times from busy times and and append both to their respective arrays
-      timeframe = Appt.from_iso_date(time_begin,time_end,"Free Time")
-      freetimes.append(busytimes_today.complement(timeframe))
-      busytimes.append(busytimes_today.normalized())
-
-      #advance the day to sync with the next iteration
-      time_begin = next_day(time_begin)
-      time_end = next_day(time_end)
-
-
-    #return this as a dict of the free and busy times
+    for date, busy, free in iter_busy_free_times(buckets, dStart, dEnd, tStart, tEnd):
+      busytimes.append(busy)
+      freetimes.append(free)
     return {"busy":busytimes, "free":freetimes}
 
-def sessionify(agenda):
-    schedule = []
+def iter_busy_free_times(buckets, dStart, dEnd, tStart, tEnd):
+    """
+    Generator: (date, busy, free) for each day from dStart to dEnd,
+    in order, where busy and free are that day's Agendas (from
+    day_busy_free). Each day is worked out only when it is asked
+    for, so the first comes as soon as it is done however long the
+    range is.
+    """
+    first = day_number(parse_iso(dStart).date())
+    last = day_number(parse_iso(dEnd).date())
+    begin = parse_iso(tStart).time()
+    end = parse_iso(tEnd).time()
+    for day in range(first, last + 1):
+      appts = tuple((appt.begin_epoch, appt.end_epoch, appt.desc)
+                    for appt in buckets.get(day, ()))
+      busy, free = day_busy_free(day, begin, end, appts)
+      yield (EPOCH + datetime.timedelta(days=day)).date(), busy, free
+
+def day_busy_free(day, begin, end, appts):
+    """
+    The busy and free times of one day (a day number, see
+    agenda.day_number) within the hours from begin to end, given
+    the day's appointments as (begin_epoch, end_epoch, desc) tuples.
+    Returns a pair of new Agendas, made from what day_blocks
+    remembers.
+    """
+    busy, free = day_blocks(day, begin, end, appts)
+    return blocks_agenda(busy), blocks_agenda(free)
+
+@functools.lru_cache(maxsize=DAY_CACHE_SIZE)
+def day_blocks(day, begin, end, appts):
+    """
+    day_busy_free's answer as a pair of tuples of (begin_epoch,
+    end_epoch, desc) tuples, which can't be changed, so every caller
+    can share them.
+    """
+    date = (EPOCH + datetime.timedelta(days=day)).date()
+    agenda = Agenda()
+    agenda.appts = [Appt.from_epoch(b, e, desc) for b, e, desc in appts]
+    busy, free = agenda.complement_range(date, date, begin, end, "Free Time")
+    return (tuple((appt.begin_epoch, appt.end_epoch, appt.desc) for appt in busy[0]),
+            tuple((appt.begin_epoch, appt.end_epoch, appt.desc) for appt in free[0]))
+
+def blocks_agenda(blocks):
+    """A new Agenda of (begin_epoch, end_epoch, desc) tuples"""
+    agenda = Agenda()
+    agenda.appts = [Appt.from_epoch(b, e, desc) for b, e, desc in blocks]
+    return agenda
+
+def bucket_events(events):
+    """
+    Make each event an Appt and group them by day (see bucket_appts).
+    Start and end times are parsed once (see event_epochs), so events
+    seen on an earlier request cost only a lookup.
+    """
+    appts = []
+    for e in events:
+      begin, end = event_epochs(e['start'], e['end'])
+      appts.append(Appt.from_epoch(begin, end, e['summary']))
+    return bucket_appts(appts)
 
-    for day in agenda:
-      itinerary = []
-      for appt in day.appts:
-        block = {"descr": appt.desc,
-                  "start": appt.begin.isoformat(),
-                  "end": appt.end.isoformat()}
-        itinerary.append(block)
-      schedule.append(itinerary)
+@functools.lru_cache(maxsize=EVENT_PARSE_CACHE_SIZE)
+def event_epochs(start, end):
+    """
+    The (begin_epoch, end_epoch) of an event from ISO start to end,
+    as Appt.from_iso_date has them
+    """
+    appt = Appt.from_iso_date(start, end, "")
+    return appt.begin_epoch, appt.end_epoch
+
+def bucket_appts(appts):
+    """
+    Group Appts by day, as a dict from day number (agenda.day_number)
+    to a list of Appts.
+    """
+    buckets = {}
+    for appt in appts:
+      buckets.setdefault(appt.begin_epoch // SECONDS_PER_DAY, []).append(appt)
+    return buckets
+
+def events_in_range(buckets, first, last):
+    """
+    The Appts in buckets (from bucket_events) on the days from the
+    date first to the date last, inclusive, grouped in day order.
+    """
+    appts = []
+    for day in range(day_number(first), day_number(last) + 1):
+      appts.extend(buckets.get(day, ()))
+    return appts
+
+def busy_free_arrays(buckets, dStart, dEnd, tStart, tEnd):
+    """
+    busy_free_times for long date ranges: all busy times go into one
+    AgendaArray, which is normalized once, and the free times of every
+    day are found in a single complement against all the daily windows.
+    """
+    first = parse_iso(dStart).date()
+    last = parse_iso(dEnd).date()
+    days = [first + datetime.timedelta(days=n)
+            for n in range((last - first).days + 1)]
+    busy = AgendaArray.from_agenda(events_in_range(buckets, first, last))
+    busy.normalize()
+
+    time_begin = parse_iso(tStart).time()
+    time_end = parse_iso(tEnd).time()
+    windows = AgendaArray.from_agenda(
+      Appt(day, time_begin, time_end, "Free Time") for day in days)
+    free = busy.complement(windows)
+
+    return {"busy":busy.by_day(days), "free":free.by_day(days)}
+
+def sessionify(agenda):
+    with app_metrics.span("sessionify"):
+      schedule = []
+
+      for day in agenda:
+        itinerary = []
+        for appt in day.appts:
+          block = {"descr": appt.desc,
+                    "start": appt.begin.isoformat(),
+                    "end": appt.end.isoformat()}
+          itinerary.append(block)
+        schedule.append(itinerary)
 
     return schedule
 
@@ -468,7 +1234,7 @@ def valid_credentials():
     return credentials
 
 
-def get_gcal_service(credentials):
+def get_gcal_service(credentials, leases=None):
   """
   We need a Google calendar 'service' object to obtain
   list of calendars, busy times, etc.  This requires
@@ -477,13 +1243,77 @@ def get_gcal_service(credentials):
   control flow will be interrupted by authorization, and we'll
   end up redirected back to /choose *without a service object*.
   Then the second call will succeed without additional authorization.
+  The service uses an Http from http_pool until the end of the
+  request; leases (from request_leases) must be given when called
+  outside the request's thread. Each thread borrows one Http per
+  request and uses it for every service it asks for, so a request
+  holds no more than one per fetch worker, however many calendars
+  it reads.
   """
   app.logger.debug("Entering get_gcal_service")
-  http_auth = credentials.authorize(httplib2.Http())
-  service = discovery.build('calendar', 'v3', http=http_auth)
+  if leases is None:
+    leases = request_leases()
+  thread = threading.get_ident()
+  for lease in leases:
+    if lease.owner == thread and lease.http is not None:
+      # Already authorized with this request's credentials
+      http_auth = lease
+      break
+  else:
+    lease = http_pool.lease(HTTP_POOL_TIMEOUT)
+    leases.append(lease)
+    http_auth = credentials.authorize(lease)
+  service = discovery.build_from_document(calendar_discovery(), http=http_auth)
   app.logger.debug("Returning service")
   return service
 
+def request_leases():
+  """
+  The list of http_pool leases taken during this request, which
+  are released when it ends (see release_leases)
+  """
+  if not hasattr(flask.g, 'leases'):
+    flask.g.leases = []
+  return flask.g.leases
+
+@app.errorhandler(httppool.PoolTimeout)
+def pool_timeout(err):
+    app.logger.warning("Http pool: {}".format(err))
+    return "Too many requests to Google at once; please try again", 503
+
+@app.teardown_request
+def release_leases(exc=None):
+  """
+  Give the Http objects used for this request back to http_pool
+  """
+  leases = getattr(flask.g, 'leases', None)
+  if leases:
+    for lease in leases:
+      lease.release()
+    app.logger.debug("Http pool: {}".format(http_pool.metrics()))
+
+def calendar_discovery():
+  """
+  The Calendar API discovery document, parsed, from which
+  get_gcal_service builds service objects. It is read only once
+  per process: from the file DISCOVERY_DOC if there is one,
+  otherwise from Google. Raises HttpError if Google won't send it.
+  """
+  global _discovery
+  with _discovery_lock:
+    if _discovery is None:
+      if DISCOVERY_DOC:
+        with open(DISCOVERY_DOC) as f:
+          _discovery = json.load(f)
+      else:
+        uri = discovery.DISCOVERY_URI.format(api='calendar', apiVersion='v3')
+        app.logger.debug("Fetching discovery document {}".format(uri))
+        resp, content = httplib2.Http().request(uri)
+        if resp.status >= 400:
+          raise HttpError(resp, content, uri=uri)
+        _discovery = json.loads(content.decode('utf-8'))
+  return _discovery
+
 @app.route('/oauth2callback')
 def oauth2callback():
   """
@@ -522,6 +1352,9 @@ def oauth2callback():
     auth_code = flask.request.args.get('code')
     credentials = flow.step2_exchange(auth_code)
     flask.session['credentials'] = credentials.to_json()
+    # This may be another Google account than before; displayEvents
+    # looks up whose it is for the event cache
+    flask.session.pop('uid', None)
     ## Now I can build the service and execute the query,
     ## but for the moment I'll just log it and go back to
     ## the main screen
@@ -538,7 +1371,7 @@ def oauth2callback():
 @app.template_filter( 'fmtdate' )
 def format_arrow_date( date ):
     try: 
-        normal = arrow.get( date )
+        normal = arrow.get( parse_iso(date) )
         return normal.format("MMM D")
     except:
         return "(bad date)"
@@ -546,7 +1379,7 @@ def format_arrow_date( date ):
 @app.template_filter( 'fmttime' )
 def format_arrow_time( time ):
     try:
-        normal = arrow.get( time )
+        normal = arrow.get( parse_iso(time) )
         return normal.format("h:mma")
     except:
         return "(bad time)"
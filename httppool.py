@@ -0,0 +1,144 @@
+"""A pool of reusable HTTP transports.
+
+   Each httplib2.Http keeps its connections open between requests
+   (HTTP/1.1 keep-alive), so a request through an Http that has
+   talked to googleapis.com before skips the TCP and TLS setup.
+   Building a new Http for every page view throws that away.  An
+   HttpPool keeps idle Http objects to lend out again, most recently
+   used first, since those are the ones whose connections are most
+   likely still open.
+
+   An Http can't be used by two threads at once, so the pool lends
+   each one to a single borrower at a time, as a Lease.  OAuth2
+   credentials authorize an Http by replacing its request method;
+   authorizing the Lease instead leaves the pooled Http untouched,
+   so the next borrower doesn't send the last one's token.
+
+   A pool may also cap how many Http objects are lent out at once;
+   borrowers past the cap wait for one to come back, and give up
+   with PoolTimeout if none does in time.
+"""
+
+import threading
+
+import httplib2
+
+class PoolTimeout(Exception):
+    """No Http came back to a full pool in time"""
+
+class Lease:
+    """An Http borrowed from a pool.  Requests go to the pooled Http
+    until the lease is released; other attributes are read from it.
+    owner is the thread that borrowed it."""
+
+    def __init__(self, pool, http):
+        self.pool = pool
+        self.http = http
+        self.owner = threading.get_ident()
+
+    def request(self, *args, **kwargs):
+        if self.http is None:
+            raise RuntimeError("Request through a released lease")
+        return self.http.request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # Only called for attributes the lease itself doesn't have
+        if self.http is None:
+            raise AttributeError(name)
+        return getattr(self.http, name)
+
+    def release(self):
+        """Give the Http back to the pool.  Releasing twice is harmless."""
+        if self.http is not None:
+            http, self.http = self.http, None
+            self.pool.release(http)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class HttpPool:
+    """Idle Http objects to lend out.  Safe to share between threads."""
+
+    def __init__(self, max_idle=8, factory=httplib2.Http, max_size=None):
+        """
+        Arguments:
+            max_idle: Most Http objects kept while nobody is using them;
+                more are made when needed, and closed when given back
+                to a full pool.
+            factory: Makes a new Http
+            max_size: Most Http objects lent out at once, or None for
+                no limit
+        """
+        if max_size is not None and max_size < max_idle:
+            raise ValueError("max_size must be at least max_idle")
+        self.max_idle = max_idle
+        self.max_size = max_size
+        self.factory = factory
+        self._idle = [ ]     # Most recently released last
+        self._lock = threading.Lock()
+        self._returned = threading.Condition(self._lock)
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.waited = 0
+
+    def acquire(self, timeout=None):
+        """
+        An Http for the caller alone, until it is released.  While
+        max_size are lent out, waits for one to be released.
+
+        Arguments:
+            timeout: Most seconds to wait, or None to wait for good
+        Raises:
+            PoolTimeout if none was released in time
+        """
+        with self._lock:
+            if self.max_size is not None and self.in_use >= self.max_size:
+                self.waited += 1
+                if not self._returned.wait_for(
+                        lambda: self.in_use < self.max_size, timeout):
+                    raise PoolTimeout("All {} Http objects are in use".format(self.max_size))
+            self.in_use += 1
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.created += 1
+        return self.factory()
+
+    def release(self, http):
+        """Return an Http from acquire to the pool"""
+        with self._lock:
+            self.in_use -= 1
+            self._returned.notify()
+            if len(self._idle) < self.max_idle:
+                self._idle.append(http)
+                return
+        close(http)
+
+    def lease(self, timeout=None):
+        """An Http from acquire, wrapped in a Lease"""
+        return Lease(self, self.acquire(timeout))
+
+    def metrics(self):
+        """Counts of Http objects: in use, idle, created and reused,
+        and of borrowers that had to wait"""
+        with self._lock:
+            return { "in_use": self.in_use, "idle": len(self._idle),
+                     "created": self.created, "reused": self.reused,
+                     "waited": self.waited }
+
+    def clear(self):
+        """Close the idle Http objects"""
+        with self._lock:
+            idle, self._idle = self._idle, [ ]
+        for http in idle:
+            close(http)
+
+def close(http):
+    """Close the open connections of an Http"""
+    for conn in list(http.connections.values()):
+        conn.close()
+    http.connections.clear()
@@ -0,0 +1,69 @@
+"""Fast, cached parsing of ISO 8601 date-time strings.
+
+   The same few timestamps (event starts and ends, the session's date
+   and time range) are parsed over and over while handling a request.
+   parse() reads the exact RFC 3339 forms that Google Calendar and
+   arrow's isoformat() produce, e.g.
+       2016-11-15T05:42:00-08:00
+       2016-11-15T13:42:00.250Z
+       2016-11-15
+   with one precompiled pattern and fixed-offset time zones, and
+   remembers recent answers in a bounded LRU cache.  Anything else
+   is handed to dateutil's general parser.
+"""
+
+import datetime
+import functools
+import re
+
+import dateutil.parser
+
+# How many distinct strings to remember
+CACHE_SIZE = 4096
+
+_DATETIME = re.compile(r"(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?"
+                       r"(Z|[+-]\d\d:?\d\d)?)?$")
+
+_UTC = datetime.timezone.utc
+_zones = { }   # "+hh:mm" -> datetime.timezone, so offsets are shared
+
+def _zone(offset):
+    """The fixed-offset time zone for a "Z" or "+hh:mm" suffix"""
+    if offset == "Z":
+        return _UTC
+    zone = _zones.get(offset)
+    if zone is None:
+        digits = offset.replace(":", "")
+        minutes = int(digits[1:3]) * 60 + int(digits[3:5])
+        if digits[0] == "-":
+            minutes = -minutes
+        zone = _zones[offset] = datetime.timezone(datetime.timedelta(minutes=minutes))
+    return zone
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse(text):
+    """Parse an ISO 8601 date or date-time string.
+
+    Arguments:
+        text: e.g. "2016-11-15T05:42:00-08:00"
+    Returns:
+        A datetime.datetime; aware (with a fixed offset) if text
+        has an offset or "Z", naive otherwise.  A date alone is
+        midnight of that day.  Callers share the returned objects,
+        which is safe because datetimes are immutable.
+    Raises:
+        ValueError if text can't be read as a date
+    """
+    match = _DATETIME.match(text)
+    if match is None:
+        return dateutil.parser.parse(text)
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    return datetime.datetime(int(year), int(month), int(day),
+                             int(hour or 0), int(minute or 0), int(second or 0),
+                             int(fraction.ljust(6, "0")) if fraction else 0,
+                             _zone(offset) if offset else None)
+
+def cache_info():
+    """Hits, misses and size of the parse cache (a functools
+    CacheInfo named tuple)."""
+    return parse.cache_info()
@@ -0,0 +1,202 @@
+"""Counters and latency histograms, in Prometheus text format.
+
+   A Registry holds named metrics:
+       Counter     a count that only goes up (events processed, ...)
+       Histogram   how many observations (e.g. seconds a step took)
+                   fell at or under each of a list of bucket bounds
+       Gauge       a value read from a function when scraped
+   Counters and histograms may carry labels, e.g. the name of a span
+   or the endpoint of a request, given as keyword arguments.
+   render() writes them all out as Prometheus scrapes them.
+
+   Instrumenting costs close to nothing when the registry is disabled:
+   span() hands back one shared do-nothing context manager, and inc()
+   and observe() return at once.
+"""
+
+import threading
+import time
+
+# Bucket bounds for latencies, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels_text(names, values):
+    if not names:
+        return ""
+    pairs = ('{}="{}"'.format(name, _escape(value))
+             for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Counter:
+    """A count per combination of label values"""
+    kind = "counter"
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = { }
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the count for these label values"""
+        if not self.registry.enabled:
+            return
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + _labels_text(self.labels, key), value
+
+class Histogram:
+    """Counts of observations at or under each bucket bound, with
+    their sum, per combination of label values"""
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = { }     # label values -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Count one observation for these label values"""
+        if not self.registry.enabled:
+            return
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            found = self._values.get(key)
+            if found is None:
+                found = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts = found[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            found[1] += value
+
+    def count(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        found = self._values.get(key)
+        return sum(found[0]) if found else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        names = self.labels + ("le",)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield (self.name + "_bucket" + _labels_text(names, key + (_number(bound),)),
+                       cumulative)
+            yield self.name + "_sum" + _labels_text(self.labels, key), total
+            yield self.name + "_count" + _labels_text(self.labels, key), cumulative
+
+class Gauge:
+    """A value read from a function when the registry is rendered"""
+    kind = "gauge"
+
+    def __init__(self, registry, name, help, function):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self):
+        yield self.name, self.function()
+
+class _Span:
+    """Times a 'with' block into a histogram"""
+    __slots__ = ("histogram", "labels", "began")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.began = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.began, **self.labels)
+
+class _NoSpan:
+    """The span of a disabled registry"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+class Registry:
+    """The metrics of an app, rendered together"""
+
+    def __init__(self, enabled=True, prefix=""):
+        """
+        Arguments:
+            enabled: Record anything at all
+            prefix: Put before every metric name, e.g. "meetme_"
+        """
+        self.enabled = enabled
+        self.prefix = prefix
+        self._metrics = [ ]
+        self.spans = self.histogram("span_seconds", "Time spent in each stage",
+                                    labels=("span",))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, self.prefix + name, help, labels, buckets))
+
+    def gauge(self, name, help, function):
+        return self._add(Gauge(self, self.prefix + name, help, function))
+
+    def span(self, name):
+        """A context manager timing its block as the span 'name'"""
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self.spans, {"span": name})
+
+    def render(self):
+        """All metrics in Prometheus text exposition format"""
+        lines = [ ]
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append("{} {}".format(name, _number(value)))
+        return "\n".join(lines) + "\n"
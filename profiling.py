@@ -0,0 +1,180 @@
+"""Profiling of single requests, on demand.
+
+   When profiling is turned on in the configuration, a request that
+   carries a valid token (in the X-Profile-Token header, or a
+   'profile' query parameter) is watched by a sampling profiler: a
+   thread that looks at the request thread's stack every few
+   milliseconds and counts the stacks it sees.  The counts are
+   written in the "collapsed stack" format that flamegraph.pl and
+   speedscope read, one line per distinct stack:
+       run (flask_main.py:123);get_busy_free_times (flask_main.py:456) 17
+   to a file in a spool directory.  The oldest files are removed when
+   the directory grows past a size limit.
+
+   A token is good for one path until it expires, and is signed with
+   a key from the configuration, so only people who know the key can
+   make requests pay for profiling.  Make one with
+       python3 profiling.py /freetime
+   Requests without a token pay only for checking that there isn't one.
+"""
+
+import collections
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+
+# Seconds between samples
+INTERVAL = 0.005
+
+HEADER = "X-Profile-Token"
+PARAMETER = "profile"
+
+def sign(key, path, expires):
+    """A token allowing profiling of requests for path until
+    time.time() is expires"""
+    expires = int(expires)
+    message = "{}|{}".format(path, expires).encode("utf-8")
+    digest = hmac.new(key.encode("utf-8"), message, hashlib.sha256).hexdigest()
+    return "{}.{}".format(expires, digest)
+
+def verify(key, path, token):
+    """Is token one from sign for this path, and not yet expired?"""
+    expires, _, digest = token.partition(".")
+    try:
+        expires = int(expires)
+    except ValueError:
+        return False
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(sign(key, path, expires), token)
+
+def frame_name(frame):
+    """How a frame appears in a collapsed stack"""
+    code = frame.f_code
+    name = "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+    return name.replace(";", ":")
+
+class Sampler:
+    """Counts the stacks of one thread, sampled by a thread of its own
+    until stop()"""
+
+    def __init__(self, thread_id=None, interval=INTERVAL):
+        """
+        Arguments:
+            thread_id: The thread to watch; the calling thread if None
+            interval: Seconds between samples
+        """
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.started = time.time()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            names = [ ]
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            names.reverse()
+            self.counts[";".join(names)] += 1
+            self.samples += 1
+
+    def stop(self):
+        """Stop sampling.  Returns the counts of each collapsed stack."""
+        self._stopping.set()
+        self._thread.join()
+        return self.counts
+
+def collapsed(counts):
+    """Collapsed-stack text of stack counts"""
+    return "".join("{} {}\n".format(stack, n) for stack, n in sorted(counts.items()))
+
+class Profiler:
+    """Profiles the requests that ask for it, into a spool directory"""
+
+    def __init__(self, key, spool, max_bytes=50 * 1024 * 1024, interval=INTERVAL):
+        """
+        Arguments:
+            key: Secret that tokens are signed with
+            spool: Directory for the profiles; created if missing
+            max_bytes: Size the spool directory is kept under, by
+                removing the oldest profiles
+            interval: Seconds between samples
+        """
+        if not key:
+            raise ValueError("Profiling needs a key to check tokens")
+        self.key = key
+        self.spool = spool
+        self.max_bytes = max_bytes
+        self.interval = interval
+        os.makedirs(spool, exist_ok=True)
+
+    def wanted(self, request):
+        """Does a request (a flask.Request) carry a good token?"""
+        token = request.headers.get(HEADER) or request.args.get(PARAMETER)
+        return bool(token) and verify(self.key, request.path, token)
+
+    def start(self):
+        """A Sampler watching the calling thread"""
+        return Sampler(interval=self.interval)
+
+    def finish(self, sampler, name):
+        """
+        Stop a sampler and write what it saw to the spool.
+
+        Arguments:
+            sampler: From start
+            name: What was profiled, e.g. the endpoint; part of the
+                file name
+        Returns:
+            The path of the profile written
+        """
+        counts = sampler.stop()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(sampler.started))
+        safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+        path = os.path.join(self.spool, "{}-{:06d}-{}.collapsed".format(
+            stamp, int(sampler.started * 1000000) % 1000000, safe))
+        with open(path, "w") as f:
+            f.write(collapsed(counts))
+        self.rotate()
+        return path
+
+    def rotate(self):
+        """Remove the oldest profiles while the spool is over max_bytes"""
+        files = [ ]
+        for name in os.listdir(self.spool):
+            if name.endswith(".collapsed"):
+                path = os.path.join(self.spool, name)
+                try:
+                    files.append((name, os.path.getsize(path), path))
+                except OSError:
+                    pass
+        files.sort()     # Names start with the time, so oldest first
+        total = sum(size for name, size, path in files)
+        for name, size, path in files[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+if __name__ == "__main__":
+    # Print a token for profiling requests to a path for the next hour
+    import CONFIG
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python3 profiling.py /path")
+    print(sign(CONFIG.PROFILE_KEY, sys.argv[1], time.time() + 3600))
@@ -0,0 +1,302 @@
+"""Server-side sessions for Flask.
+
+   Flask's own sessions are signed cookies holding everything in the
+   session, which the browser sends back on every request.  The events
+   page and the free and busy schedules don't fit: past about 4KB the
+   browser drops the cookie and the session is silently lost.  Here
+   the session is kept on the server, and the cookie holds only a
+   random session id, signed with the app's secret key so a client
+   can't make one up.
+
+   Sessions are encoded compactly (see codec) in one of three stores:
+       MemoryStore   in this process, least recently used evicted
+       FileStore     a file per session in a directory
+       SqliteStore   a table in an SQLite database file
+   The file and SQLite stores outlive the process and can be shared by
+   several worker processes.  Sessions expire after the app's
+   PERMANENT_SESSION_LIFETIME.
+"""
+
+import binascii
+import collections
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+import codec
+
+class ServerSession(CallbackDict, SessionMixin):
+    """A session dict that knows its id and whether it was changed"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+class ServerSessionInterface(SessionInterface):
+    """Sessions kept in a store, found by the signed id in the cookie"""
+
+    salt = "server-session"
+
+    def __init__(self, store, serializer=None):
+        """
+        Arguments:
+            store: A MemoryStore, FileStore or SqliteStore
+            serializer: Turns session dicts into bytes and back
+                (dumps and loads); the codec module by default
+        """
+        self.store = store
+        self.serializer = serializer or codec
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode("ascii")
+            except BadSignature:
+                sid = None
+            if sid:
+                blob = self.store.get(sid)
+                if blob is not None:
+                    try:
+                        return ServerSession(self.serializer.loads(blob), sid)
+                    except ValueError:
+                        pass
+        return ServerSession(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = app.config["SESSION_COOKIE_NAME"]
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.put(session.sid, self.serializer.dumps(dict(session)),
+                       time.time() + lifetime)
+        cookie = self._signer(app).sign(session.sid.encode("ascii"))
+        response.set_cookie(name, cookie.decode("ascii"),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
+
+def new_sid():
+    """A random session id, as hex text"""
+    return binascii.hexlify(os.urandom(16)).decode("ascii")
+
+def valid_sid(sid):
+    """Is sid something new_sid could have made?"""
+    return len(sid) == 32 and all(c in "0123456789abcdef" for c in sid)
+
+class MemoryStore:
+    """Sessions in this process, up to max_sessions of them, least
+    recently used evicted first.  Safe to share between threads."""
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._sessions = collections.OrderedDict()   # sid -> (expires, blob)
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        """The stored bytes of a session, or None if it has expired"""
+        with self._lock:
+            found = self._sessions.get(sid)
+            if found is None:
+                return None
+            expires, blob = found
+            if expires < time.time():
+                del self._sessions[sid]
+                return None
+            self._sessions.move_to_end(sid)
+            return blob
+
+    def put(self, sid, blob, expires):
+        """Store a session's bytes until time.time() is expires"""
+        with self._lock:
+            self._sessions.pop(sid, None)
+            self._sessions[sid] = (expires, blob)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+class FileStore:
+    """Sessions as files in a directory, each the expiry time (a
+    big-endian double) followed by the session's bytes.  Files are
+    replaced atomically; expired ones are removed when read, and in
+    a sweep of the whole directory every SWEEP_EVERY saves."""
+
+    SWEEP_EVERY = 1000
+    _EXPIRES = struct.Struct(">d")
+
+    def __init__(self, directory):
+        """The directory is created if missing; it should be private
+        to the app, since sessions hold users' credentials."""
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._saves = 0
+
+    def _path(self, sid):
+        if not valid_sid(sid):
+            raise ValueError("Bad session id")
+        return os.path.join(self.directory, sid)
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < self._EXPIRES.size:
+            return None
+        expires, = self._EXPIRES.unpack_from(data)
+        if expires < time.time():
+            self._unlink(path)
+            return None
+        return data[self._EXPIRES.size:]
+
+    def get(self, sid):
+        """The stored bytes of a session, or None if it has expired"""
+        if not valid_sid(sid):
+            return None
+        return self._read(self._path(sid))
+
+    def put(self, sid, blob, expires):
+        """Store a session's bytes until time.time() is expires"""
+        path = self._path(sid)
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._EXPIRES.pack(expires))
+                f.write(blob)
+            os.replace(temp, path)
+        except BaseException:
+            self._unlink(temp)
+            raise
+        self._saves += 1
+        if self._saves % self.SWEEP_EVERY == 0:
+            self.sweep()
+
+    def delete(self, sid):
+        if valid_sid(sid):
+            self._unlink(self._path(sid))
+
+    def sweep(self):
+        """Remove the files of expired sessions"""
+        for name in os.listdir(self.directory):
+            if valid_sid(name):
+                self._read(os.path.join(self.directory, name))
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if valid_sid(name))
+
+class SqliteStore:
+    """Sessions in a table of an SQLite database.  Each thread has a
+    connection of its own.  Expired rows are removed when read, and
+    all at once every SWEEP_EVERY saves."""
+
+    SWEEP_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._saves = 0
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                       "(sid TEXT PRIMARY KEY, expires REAL, data BLOB)")
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=10)
+        return db
+
+    def get(self, sid):
+        """The stored bytes of a session, or None if it has expired"""
+        db = self._connection()
+        row = db.execute("SELECT expires, data FROM sessions WHERE sid = ?",
+                         (sid,)).fetchone()
+        if row is None:
+            return None
+        expires, blob = row
+        if expires < time.time():
+            self.delete(sid)
+            return None
+        return bytes(blob)
+
+    def put(self, sid, blob, expires):
+        """Store a session's bytes until time.time() is expires"""
+        with self._connection() as db:
+            db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                       (sid, expires, sqlite3.Binary(blob)))
+        self._saves += 1
+        if self._saves % self.SWEEP_EVERY == 0:
+            self.sweep()
+
+    def delete(self, sid):
+        with self._connection() as db:
+            db.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def sweep(self):
+        """Remove expired sessions"""
+        with self._connection() as db:
+            db.execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+def open_session_interface(backend="memory", path=None):
+    """
+    Factory: The session interface for a backend.
+
+    Arguments:
+        backend: "memory", "file" (path is a directory), "sqlite"
+            (path is a database file), or "cookie" for Flask's own
+            signed-cookie sessions
+        path: Where the file and sqlite backends keep sessions
+    Returns:
+        A ServerSessionInterface, or None for "cookie"
+    Raises:
+        ValueError if the backend is unknown or needs a path
+    """
+    if backend == "cookie":
+        return None
+    if backend == "memory":
+        return ServerSessionInterface(MemoryStore())
+    if backend in ("file", "sqlite"):
+        if not path:
+            raise ValueError("The {} session backend needs a path".format(backend))
+        store = FileStore(path) if backend == "file" else SqliteStore(path)
+        return ServerSessionInterface(store)
+    raise ValueError("Unknown session backend {}".format(backend))
@@ -35,6 +35,30 @@ PORT=${port}
 DEBUG = True  # Set to False for production use
 secret_key="${secret}"
 
+# Calendar events kept between visits: "memory", "disk" or None
+EVENT_CACHE = "memory"
+EVENT_CACHE_DIR = "cache/events"   # Used by "disk"
+
+# Where sessions are kept: "memory", "file" (a directory), "sqlite"
+# (a database file), or "cookie" for Flask's cookie sessions
+SESSION_BACKEND = "memory"
+SESSION_PATH = "cache/sessions"   # Used by "file" and "sqlite"
+
+# Most connections to Google in use at once, by all requests
+HTTP_POOL_SIZE = 32
+
+# Serve timings and counts for Prometheus on /metrics
+METRICS = False
+
+# Profile requests carrying a token (python3 profiling.py /path)
+PROFILE = False
+PROFILE_KEY = "$(date +%s%N | shasum | head -c32)"
+PROFILE_DIR = "profiles"
+
+# A saved copy of the Calendar API discovery document, to skip
+# fetching it from Google when the app starts; None to fetch it
+DISCOVERY_DOC = None
+
 EOF
 }
 
@@ -4,10 +4,14 @@ Nose tests for flask_main.py
 # Date handling 
 import arrow # Replacement for datetime, based on moment.js
 import datetime # But we still need time
+import io
+import random
+from unittest import SkipTest
 from dateutil import tz  # For interpreting local times
 
 # modules we are testing
-from agenda import Appt, Agenda
+from agenda import Appt, Agenda, AgendaArray, HAVE_NUMPY
+import bench_agenda
 
 """
 The testing done here is focused on my modifications to agenda.py since
@@ -32,4 +36,264 @@ def test_appt():
     print("{}    {}".format(output.start_isoformat(),start_as_iso))
     assert output.start_isoformat() == start_as_iso
     assert output.end_isoformat() == end_as_iso
-    
\ No newline at end of file
+    
+
+def nested_intersect(mine, theirs):
+    """
+    The original all-pairs intersection, used as a reference
+    """
+    result = Agenda()
+    for thisappt in mine.appts:
+        for otherappt in theirs.appts:
+            if thisappt.overlaps(otherappt):
+                result.append(thisappt.intersect(otherappt))
+    return result
+
+def test_intersect():
+    """
+    Testing Agenda.intersect against the all-pairs intersection
+    """
+    keiko = Agenda.from_file(io.StringIO("""
+        2012.12.1 07:00 08:00  | Possible breakfast meeting
+        2012.12.1 10:00 12:00  | Late morning meeting
+        2012.12.1 14:00 18:00  | Afternoon meeting
+        """))
+    kevin = Agenda.from_file(io.StringIO("""
+        2012.11.30 09:00 14:00 | I have an afternoon commitment on the 30th
+        2012.12.1  09:00 15:00 | I prefer morning meetings
+        2012.12.1  11:00 14:30 | Overlaps my own morning
+        """))
+
+    assert str(keiko.intersect(kevin)) == str(nested_intersect(keiko, kevin))
+    assert str(kevin.intersect(keiko)) == str(nested_intersect(kevin, keiko))
+    assert str(keiko.intersect(kevin)) == (
+        "2012.12.01 10:00 12:00 | Late morning meeting\n" +
+        "2012.12.01 11:00 12:00 | Late morning meeting\n" +
+        "2012.12.01 14:00 15:00 | Afternoon meeting\n" +
+        "2012.12.01 14:00 14:30 | Afternoon meeting")
+    assert str(keiko.intersect(kevin, "Meet")).count("| Meet") == 4
+    assert len(keiko.intersect(Agenda())) == 0
+
+def test_intersect_random():
+    """
+    Randomized agendas, including touching and overlapping appointments
+    """
+    rand = random.Random(322)
+    def random_agenda(n):
+        agenda = Agenda()
+        for i in range(n):
+            begin = rand.randrange(0, 23 * 60)
+            end = rand.randrange(begin + 1, 24 * 60)
+            agenda.append(Appt(datetime.date(2016, 11, rand.randrange(15, 18)),
+                               datetime.time(begin // 60, begin % 60),
+                               datetime.time(end // 60, end % 60),
+                               "appt {}".format(i)))
+        return agenda
+
+    for trial in range(20):
+        mine = random_agenda(rand.randrange(0, 30))
+        theirs = random_agenda(rand.randrange(0, 30))
+        assert str(mine.intersect(theirs)) == str(nested_intersect(mine, theirs))
+
+def test_intersect_all():
+    """
+    Testing Agenda.intersect_all, everyone and quorum
+    """
+    keiko = Agenda.from_file(io.StringIO("""
+        2012.12.1 07:00 08:00  | Possible breakfast meeting
+        2012.12.1 10:00 12:00  | Late morning meeting
+        2012.12.1 14:00 18:00  | Afternoon meeting
+        """))
+    kevin = Agenda.from_file(io.StringIO("""
+        2012.11.30 09:00 14:00 | I have an afternoon commitment on the 30th
+        2012.12.1  09:00 15:00 | I prefer morning meetings
+        """))
+    emanuela = Agenda.from_file(io.StringIO("""
+        2012.12.1 12:00 14:00 | Early afternoon
+        2012.12.1 16:00 18:00 | Late afternoon into evening
+        2012.12.2 8:00 17:00 | All the next day
+        """))
+
+    pairwise = Agenda.intersect_all([keiko, kevin])
+    assert str(pairwise) == str(keiko.intersect(kevin))
+    assert len(Agenda.intersect_all([keiko, kevin, emanuela])) == 0
+    assert str(Agenda.intersect_all([keiko, kevin, emanuela], quorum=2, desc="Meet")) == (
+        "2012.12.01 10:00 15:00 | Meet\n" +
+        "2012.12.01 16:00 18:00 | Meet")
+    # Touching appointments don't make a zero-length overlap
+    assert str(Agenda.intersect_all([keiko, emanuela], quorum=2)) == (
+        "2012.12.01 16:00 18:00 | Afternoon meeting")
+    assert len(Agenda.intersect_all([keiko], quorum=2)) == 0
+    assert len(Agenda.intersect_all([])) == 0
+
+def test_intersect_all_random():
+    """
+    With everyone required, intersect_all matches chained intersects
+    """
+    for seed in range(10):
+        agendas = [ bench_agenda.random_agenda(40, days=3, seed=seed * 10 + k)
+                    for k in range(4) ]
+        chained = agendas[0]
+        for agenda in agendas[1:]:
+            chained = chained.intersect(agenda)
+        assert blocks(Agenda.intersect_all(agendas)) == blocks(chained)
+
+def blocks(agenda):
+    """
+    The blocks of time covered by an agenda, with blocks that
+    meet end to end joined together
+    """
+    result = [ ]
+    for appt in agenda.normalized():
+        if result and result[-1][1] == appt.begin:
+            result[-1] = (result[-1][0], appt.end)
+        else:
+            result.append((appt.begin, appt.end))
+    return result
+
+def test_appt_epoch():
+    """
+    Testing the integer representation behind Appt
+    """
+    appt = Appt(datetime.date(2016, 11, 15), datetime.time(9, 30),
+                datetime.time(10, 45), "Standup")
+    assert not hasattr(appt, "__dict__")
+    assert appt.end_epoch - appt.begin_epoch == 75 * 60
+    assert appt.begin == datetime.datetime(2016, 11, 15, 9, 30)
+    assert appt.end == datetime.datetime(2016, 11, 15, 10, 45)
+    assert str(Appt.from_epoch(appt.begin_epoch, appt.end_epoch, "Standup")) == str(appt)
+
+    later = Appt.from_string("2016.11.15 10:00 12:00 | Later")
+    assert str(appt.intersect(later)) == "2016.11.15 10:00 10:45 | Standup"
+    assert str(appt.union(later, "Both")) == "2016.11.15 09:30 12:00 | Both"
+
+    try:
+        Appt.from_epoch(appt.begin_epoch, appt.begin_epoch + 24 * 60 * 60, "Too long")
+        assert False, "Appt spanning two days should raise ValueError"
+    except ValueError:
+        pass
+
+def test_agenda_array():
+    """
+    AgendaArray gives the same answers as Agenda
+    """
+    if not HAVE_NUMPY:
+        raise SkipTest("numpy is not installed")
+    busy = bench_agenda.random_agenda(200, days=4, seed=7)
+    other = bench_agenda.random_agenda(200, days=4, seed=8)
+    array = AgendaArray.from_agenda(busy)
+    assert str(array.to_agenda()) == str(busy)
+    assert str(array.normalized().to_agenda()) == str(busy.normalized())
+
+    intersection = array.intersect(AgendaArray.from_agenda(other)).to_agenda()
+    assert str(intersection) == str(busy.normalized().intersect(other.normalized()))
+
+    days = [ datetime.date(2016, 11, d) for d in range(1, 6) ]
+    windows = [ Appt(day, datetime.time(7), datetime.time(21), "Free") for day in days ]
+    free = array.complement(AgendaArray.from_agenda(windows))
+    by_day = free.by_day(days)
+    for window, free_today in zip(windows, by_day):
+        assert str(free_today) == str(busy.complement(window))
+    assert str(array.complement(windows[4]).to_agenda()) == str(windows[4])
+
+def test_agenda_array_touching():
+    """
+    Busy blocks that touch (one ends as the next begins) leave no
+    empty free time between them
+    """
+    if not HAVE_NUMPY:
+        raise SkipTest("numpy is not installed")
+    window = Appt.from_string("2016.11.01 07:00 21:00 | Free")
+    touching = Agenda()
+    touching.append(Appt.from_string("2016.11.01 09:00 10:00 | A"))
+    touching.append(Appt.from_string("2016.11.01 10:00 11:00 | B"))
+    touching.append(Appt.from_string("2016.11.01 11:00 12:00 | C"))
+    free = AgendaArray.from_agenda(touching).complement(window).to_agenda()
+    assert str(free) == str(touching.complement(window))
+    assert len(free.appts) == 2
+
+def test_interval_index():
+    """
+    Agenda.overlapping, at and is_free against a linear scan
+    """
+    agenda = bench_agenda.random_agenda(300, days=3, seed=5)
+    probes = bench_agenda.random_agenda(200, days=4, seed=6)
+    for probe in probes:
+        expected = sorted((appt for appt in agenda if appt.overlaps(probe)),
+                          key=lambda appt: appt.begin_epoch)
+        assert [str(a) for a in agenda.overlapping(probe)] == [str(a) for a in expected]
+        assert agenda.is_free(probe) == (len(expected) == 0)
+        in_progress = [ a for a in expected if a.begin <= probe.begin < a.end ]
+        assert [str(a) for a in agenda.at(probe.begin)] == [str(a) for a in in_progress]
+
+    # The index is rebuilt after the agenda changes
+    lunch = Appt.from_string("2016.12.25 12:00 13:00 | Lunch")
+    assert agenda.is_free(lunch)
+    agenda.append(lunch)
+    assert not agenda.is_free(lunch)
+    assert [str(a) for a in agenda.at(lunch.begin)] == [str(lunch)]
+    # Touching is not overlapping
+    assert agenda.is_free(Appt.from_string("2016.12.25 13:00 14:00 | After lunch"))
+
+def test_iter_file():
+    """
+    Agenda.iter_file reads lines like Appt.from_string and reports bad ones
+    """
+    text = """# A comment
+        2012.12.1 07:00 08:00  | Possible breakfast meeting
+        2013.11.26 17:00  18:30 | he blew his mind out in a car
+        2013.12.2 8:00 17:00 | Single digit hour
+        2013.12.02 8:5 9:00 | Single digit minute
+
+        2013.12.02 15:00 14:00 | time traveler
+        2013.02.30 10:00 11:00 | No such day
+        2013.12.02 10:00 11:00 | Too | many bars
+        2013.12.02 24:00 25:00 | Late night
+        """
+    errors = [ ]
+    appts = Agenda.iter_file(io.StringIO(text), errors)
+    assert len(errors) == 0     # Nothing read yet
+    appts = list(appts)
+    lines = [ line.strip() for line in text.split("\n") ]
+    good = [ ]
+    for line in lines[1:5]:
+        good.append(str(Appt.from_string(line)))
+    assert [ str(appt) for appt in appts ] == good
+    assert [ error.lineno for error in errors ] == [7, 8, 9, 10]
+    assert errors[0].line == "2013.12.02 15:00 14:00 | time traveler"
+    assert errors[0].message == "Appointment end must be after begin"
+
+    agenda = Agenda.from_file(io.StringIO(text), errors)
+    assert len(agenda) == 4
+    assert len(errors) == 8
+
+def test_complement_range():
+    """
+    Agenda.complement_range against complement one day at a time
+    """
+    agenda = bench_agenda.random_agenda(120, days=6, seed=9)
+    busy, free = agenda.complement_range(datetime.date(2016, 10, 30),
+                                         datetime.date(2016, 11, 8),
+                                         datetime.time(8, 30), datetime.time(17),
+                                         "Free")
+    assert len(busy) == len(free) == 10
+    for offset in range(10):
+        day = datetime.date(2016, 10, 30) + datetime.timedelta(days=offset)
+        today = Agenda()
+        for appt in agenda:
+            if appt.begin.date() == day:
+                today.append(appt)
+        window = Appt(day, datetime.time(8, 30), datetime.time(17), "Free")
+        assert str(free[offset]) == str(today.complement(window))
+        assert str(busy[offset]) == str(today.normalized())
+
+def test_synthetic_agenda():
+    """
+    The benchmark generator's density controls how much overlaps
+    """
+    apart = bench_agenda.synthetic_agenda(60, days=10, density=0.0, seed=3)
+    crowded = bench_agenda.synthetic_agenda(60, days=10, density=0.9, seed=3)
+    assert len(apart.appts) == len(crowded.appts) == 60
+    assert len(apart.normalized().appts) == 60
+    assert len(crowded.normalized().appts) < 30
+    assert str(crowded) == str(bench_agenda.synthetic_agenda(60, days=10, density=0.9, seed=3))
@@ -0,0 +1,80 @@
+"""
+Nose tests for availability.py
+"""
+import datetime
+import io
+import random
+
+# modules we are testing
+from agenda import Appt, Agenda
+from availability import Availability
+
+def on_grid_agenda(n, rand, days=3):
+    """
+    n random appointments whose times are all multiples of 15 minutes
+    """
+    agenda = Agenda()
+    for i in range(n):
+        begin = rand.randrange(0, 95) * 15
+        end = rand.randrange(begin // 15 + 1, 96) * 15
+        agenda.append(Appt(datetime.date(2016, 11, 15 + rand.randrange(days)),
+                           datetime.time(begin // 60, begin % 60),
+                           datetime.time(end // 60, end % 60),
+                           "appt {}".format(i)))
+    return agenda
+
+def test_complement_matches_agenda():
+    """
+    On the grid, Availability.complement is Agenda.complement
+    """
+    rand = random.Random(6)
+    for trial in range(20):
+        agendas = [ on_grid_agenda(rand.randrange(1, 10), rand) for k in range(4) ]
+        everyone = Agenda()
+        for agenda in agendas:
+            for appt in agenda:
+                everyone.append(appt)
+        combined = Availability.combine(Availability.from_agenda(agenda)
+                                        for agenda in agendas)
+        for day in range(15, 19):
+            window = Appt(datetime.date(2016, 11, day), datetime.time(8),
+                          datetime.time(18, 30), "Free")
+            assert str(combined.complement(window)) == str(everyone.complement(window))
+
+def test_rounding():
+    """
+    Busy time rounds outward, free time rounds inward
+    """
+    agenda = Agenda.from_file(io.StringIO("""
+        2016.11.15 09:05 09:20 | Short
+        2016.11.15 12:00 13:00 | Lunch
+        """))
+    grid = Availability.from_agenda(agenda, granularity=15)
+    window = Appt.from_string("2016.11.15 08:50 13:40 | Free")
+    assert str(grid.complement(window)) == (
+        "2016.11.15 09:30 12:00 | Free\n" +
+        "2016.11.15 13:00 13:30 | Free")
+    assert not grid.is_free(Appt.from_string("2016.11.15 09:25 09:40 | Coffee"))
+    assert grid.is_free(Appt.from_string("2016.11.15 09:30 09:40 | Coffee"))
+    assert grid.is_free(Appt.from_string("2016.11.16 09:00 17:00 | Tomorrow"))
+
+def test_and_or():
+    """
+    Combining availabilities bitwise
+    """
+    keiko = Availability.from_agenda(Agenda.from_file(io.StringIO(
+        "2016.11.15 09:00 11:00 | Keiko busy")), granularity=30)
+    kevin = Availability.from_agenda(Agenda.from_file(io.StringIO(
+        "2016.11.15 10:00 12:00 | Kevin busy")), granularity=30)
+    window = Appt.from_string("2016.11.15 08:00 13:00 | Free")
+    assert str((keiko | kevin).complement(window)) == (
+        "2016.11.15 08:00 09:00 | Free\n" +
+        "2016.11.15 12:00 13:00 | Free")
+    assert str((keiko & kevin).complement(window)) == (
+        "2016.11.15 08:00 10:00 | Free\n" +
+        "2016.11.15 11:00 13:00 | Free")
+    try:
+        keiko | Availability(granularity=15)
+        assert False, "Mixing granularities should raise ValueError"
+    except ValueError:
+        pass
@@ -0,0 +1,64 @@
+"""
+Nose tests for codec.py
+"""
+import json
+import random
+
+import codec
+
+def session_sample(n=50, seed=0):
+    """A session like the events and free times pages leave"""
+    rand = random.Random(seed)
+    events = [ ]
+    for i in range(n):
+        day = 15 + i // 10
+        hour = 8 + i % 10
+        events.append({"kind": "calendar#event", "id": "id{}".format(rand.getrandbits(40)),
+                       "summary": rand.choice(["Lunch", "Class", "Meeting"]),
+                       "start": "2016-11-{}T{:02d}:00:00-08:00".format(day, hour),
+                       "end": "2016-11-{}T{:02d}:30:00-08:00".format(day, hour),
+                       "show": True})
+    free = [ [ {"descr": "Free Time", "start": "2016-11-{}T09:00:00".format(day),
+                "end": "2016-11-{}T12:00:00".format(day)},
+               {"descr": "Free Time", "start": "2016-11-{}T13:00:00".format(day),
+                "end": "2016-11-{}T17:00:00".format(day)} ]
+             for day in range(15, 22) ]
+    return {"events": events, "free": free, "busy": [[] for day in free],
+            "begin_date": "2016-11-15T00:00:00-08:00",
+            "credentials": json.dumps({"access_token": "x"}),
+            "_flashes": [["message", "Updated date and time range"]]}
+
+def test_round_trip():
+    session = session_sample()
+    for compress in (True, False):
+        blob = codec.dumps(session, compress)
+        assert codec.loads(blob) == session
+    assert len(codec.dumps(session)) < len(json.dumps(session)) / 4
+
+def test_fallback():
+    """
+    Values that would not come back as the same text stay JSON
+    """
+    odd = [
+        {"descr": "Seconds", "start": "2016-11-15T09:00:30", "end": "2016-11-15T10:00:00"},
+        {"descr": "Fraction", "start": "2016-11-15T09:00:00.5", "end": "2016-11-15T10:00:00"},
+        {"descr": "Lowercase", "start": "2016-11-15t09:00:00", "end": "2016-11-15T10:00:00"},
+        {"descr": "Short offset", "start": "2016-11-15T09:00:00-0800", "end": "2016-11-15T10:00:00"},
+        {"descr": "Far future", "start": "9999-12-31T23:59:00", "end": "9999-12-31T23:59:00"},
+        {"descr": 5, "start": "2016-11-15T09:00:00", "end": "2016-11-15T10:00:00"},
+        ]
+    for block in odd:
+        session = {"free": [[block]], "events": [dict(block, extra=1)]}
+        assert codec.loads(codec.dumps(session)) == session
+    session = {"free": [[{"descr": "Zulu", "start": "2016-11-15T09:00:00Z",
+                          "end": "2016-11-16T00:00:00+05:30"}]],
+               "events": [], "nested": {"a": [1, 2]}, "flag": False}
+    assert codec.loads(codec.dumps(session)) == session
+
+def test_bad_input():
+    for blob in (b"", b"{}", codec.MAGIC + b"z" + b"garbage", codec.MAGIC + b"?"):
+        try:
+            codec.loads(blob)
+            assert False, "Expected ValueError"
+        except ValueError:
+            pass
@@ -0,0 +1,71 @@
+"""
+Nose tests for eventcache.py
+"""
+import tempfile
+import time
+
+from eventcache import CacheEntry, MemoryCache, DiskCache, open_cache
+
+def entry(n, token="token", synced=None):
+    """An entry of n made-up events"""
+    return CacheEntry({ "e{}".format(i): {"id": "e{}".format(i)} for i in range(n) },
+                      token, synced)
+
+def test_memory_lru():
+    cache = MemoryCache(max_events=10)
+    cache.put(("me", "a"), entry(4))
+    cache.put(("me", "b"), entry(4))
+    assert cache.get(("me", "a")) is not None    # a is now most recent
+    cache.put(("me", "c"), entry(4))             # 12 events: b goes
+    assert cache.get(("me", "b")) is None
+    assert cache.get(("me", "a")).sync_token == "token"
+    assert len(cache) == 2
+    # An entry over the cap by itself is still kept
+    cache.put(("me", "d"), entry(20))
+    assert len(cache) == 1 and cache.get(("me", "d")) is not None
+
+def test_memory_ttl():
+    cache = MemoryCache(ttl=60)
+    cache.put("old", entry(1, synced=time.time() - 120))
+    cache.put("new", entry(1))
+    assert cache.get("old") is None
+    assert cache.get("new") is not None
+    cache.discard("new")
+    assert len(cache) == 0
+
+def test_disk():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DiskCache(directory, ttl=60)
+        cache.put(("me", "a"), CacheEntry(entry(3).events, "t1",
+                                          since="2016-10-15T00:00:00+00:00",
+                                          until="2017-11-15T00:00:00+00:00"))
+        cache.put(("me", "old"), entry(3, synced=time.time() - 120))
+        # Another process sees the same entries
+        other = DiskCache(directory, ttl=60)
+        found = other.get(("me", "a"))
+        assert found.sync_token == "t1" and sorted(found.events) == ["e0", "e1", "e2"]
+        assert found.since == "2016-10-15T00:00:00+00:00"
+        assert found.until == "2017-11-15T00:00:00+00:00"
+        assert other.get(("me", "old")) is None
+        assert other.get(("you", "a")) is None
+        assert len(cache) == 1
+
+def test_disk_cap():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DiskCache(directory, max_bytes=1)
+        cache.put("a", entry(100))
+        cache.put("b", entry(100))
+        assert cache.get("a") is None
+        assert cache.get("b") is not None
+
+def test_open_cache():
+    assert open_cache(None) is None
+    assert isinstance(open_cache(), MemoryCache)
+    with tempfile.TemporaryDirectory() as directory:
+        assert isinstance(open_cache("disk", directory), DiskCache)
+    for bad in [("disk", None), ("redis", None)]:
+        try:
+            open_cache(*bad)
+            assert False, "Expected ValueError"
+        except ValueError:
+            pass
@@ -4,11 +4,26 @@ Nose tests for flask_main.py
 # Date handling 
 import arrow # Replacement for datetime, based on moment.js
 import datetime # But we still need time
+import json
+import random
+import tempfile
+import threading
+from unittest import SkipTest
 from dateutil import tz  # For interpreting local times
+import httplib2
+from apiclient.errors import HttpError
+from oauth2client import client
 
 # modules we are testing
 from flask_main import interpret_time, interpret_date, in_time_frame
-from flask_main import same_date, combine_date_time
+from flask_main import same_date, combine_date_time, get_busy_free_times
+from flask_main import bucket_events, events_in_range, busy_free_days, day_blocks
+from flask_main import filter_time_frame
+from flask_main import next_day, local_time, format_arrow_date, format_arrow_time
+from flask_main import fetch_events, freebusy_appts, sync_calendar
+from agenda import HAVE_NUMPY
+from eventcache import MemoryCache
+import flask_main
 from agenda import Appt, Agenda
 
 def test_interpret_time():
@@ -48,6 +63,30 @@ def test_in_time_frame():
     assert in_time_frame(start,end,interpret_time("12:00pm",fmt),interpret_time("12:30pm",fmt)) == True
     assert in_time_frame(start,end,interpret_time("11:00am",fmt),interpret_time("1:00pm",fmt)) == True
 
+def test_filter_time_frame():
+    """
+    The batch filter agrees with the four cases in_time_frame used to
+    check, with and without numpy, including frames and events that
+    wrap past midnight
+    """
+    def legacy(start, end, lower, upper):
+        s, e = local_time(start), local_time(end)
+        lb, ub = local_time(lower), local_time(upper)
+        return ((s <= lb and e >= lb) or (s >= lb and e <= ub) or
+                (s <= ub and e >= ub) or (s <= lb and e >= ub))
+
+    rand = random.Random(1)
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    def at(quarter):
+        return day.replace(minutes=+15 * quarter).isoformat()
+    starts = [at(rand.randrange(96)) for i in range(300)]
+    ends = [at(rand.randrange(96)) for i in range(300)]
+    frames = [(at(36), at(68)), (at(68), at(36)), (at(40), at(40)), (at(0), at(95))]
+    for lower, upper in frames:
+        expected = [legacy(s, e, lower, upper) for s, e in zip(starts, ends)]
+        assert filter_time_frame(starts, ends, lower, upper) == expected        # numpy
+        assert filter_time_frame(starts[:20], ends[:20], lower, upper) == expected[:20]
+
 """
 Everything below here is the new tests added for proj8
 """
@@ -76,4 +115,623 @@ def test_combine_date_time():
     test_input2 = arrow.get(a_time,"MM/DD/YYYY h:mma").replace(tzinfo=tz.tzlocal())
     desired_output = arrow.get("11/15/2016 1:30pm","MM/DD/YYYY h:mma").replace(tzinfo=tz.tzlocal()).isoformat()
 
-    assert combine_date_time(test_input1,test_input2) == desired_output
\ No newline at end of file
+    assert combine_date_time(test_input1,test_input2) == desired_output
+
+def at(days, hours):
+    """
+    ISO text of a local time, days and hours after 11/15/2016
+    """
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    return day.replace(days=+days, hours=+hours).isoformat()
+
+def test_busy_free_arrays():
+    """
+    The numpy path of get_busy_free_times gives the same days as the Agenda path
+    """
+    if not HAVE_NUMPY:
+        raise SkipTest("numpy is not installed")
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    events = [{"start": at(0, 8), "end": at(0, 10), "summary": "Breakfast"},
+              {"start": at(0, 9), "end": at(0, 11), "summary": "Meeting"},
+              {"start": at(0, 15), "end": at(0, 18), "summary": "Late"},
+              {"start": at(2, 12), "end": at(2, 13), "summary": "Lunch"}]
+    dStart = day.isoformat()
+    dEnd = day.replace(days=+3).isoformat()
+    tStart = interpret_time("9:00am")
+    tEnd = interpret_time("5:00pm")
+
+    plain = get_busy_free_times(events, dStart, dEnd, tStart, tEnd, vectorized=False)
+    arrays = get_busy_free_times(events, dStart, dEnd, tStart, tEnd, vectorized=True)
+    assert len(plain["free"]) == len(arrays["free"]) == 4
+    for kind in ("busy", "free"):
+        assert [str(ag) for ag in plain[kind]] == [str(ag) for ag in arrays[kind]]
+    assert str(arrays["free"][0]) == "2016.11.15 11:00 15:00 | Free Time"
+    assert str(arrays["busy"][0]) == ("2016.11.15 08:00 11:00 | Breakfast Meeting\n" +
+                                      "2016.11.15 15:00 18:00 | Late")
+
+    # Back-to-back events over a range long enough to go the numpy way
+    # by default
+    events = [{"start": at(1, 10), "end": at(1, 11), "summary": "First"},
+              {"start": at(1, 11), "end": at(1, 12), "summary": "Second"}]
+    dEnd = day.replace(days=+flask_main.VECTORIZE_DAYS).isoformat()
+    arrays = get_busy_free_times(events, dStart, dEnd, tStart, tEnd)
+    plain = get_busy_free_times(events, dStart, dEnd, tStart, tEnd, vectorized=False)
+    assert [str(ag) for ag in arrays["free"]] == [str(ag) for ag in plain["free"]]
+    assert str(arrays["free"][1]) == ("2016.11.16 09:00 10:00 | Free Time\n" +
+                                      "2016.11.16 12:00 17:00 | Free Time")
+
+def test_bucket_events():
+    """
+    Events are parsed once and grouped by day
+    """
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    events = [{"start": at(2, 12), "end": at(2, 13), "summary": "Lunch"},
+              {"start": at(0, 9), "end": at(0, 11), "summary": "Meeting"},
+              {"start": at(-1, 9), "end": at(-1, 11), "summary": "Too early"},
+              {"start": at(0, 8), "end": at(0, 10), "summary": "Breakfast"}]
+    buckets = bucket_events(events)
+    assert len(buckets) == 3
+    in_range = events_in_range(buckets, day.date(), day.replace(days=+2).date())
+    assert [appt.desc for appt in in_range] == ["Meeting", "Breakfast", "Lunch"]
+
+def test_parse_iso_helpers():
+    """
+    next_day and the template filters agree with arrow
+    """
+    samples = [interpret_time("11:20pm"), interpret_date("11/15/2016"),
+               "2016-11-15T05:42:00-08:00", "2016-11-15T13:42:00Z",
+               "2016-11-15T13:42:00"]
+    for text in samples:
+        assert next_day(text) == arrow.get(text).replace(days=+1).isoformat()
+        assert format_arrow_date(text) == arrow.get(text).format("MMM D")
+        assert format_arrow_time(text) == arrow.get(text).format("h:mma")
+        assert local_time(text) == arrow.get(text).to('local').time()
+    assert format_arrow_time("not a time") == "(bad time)"
+
+class FakeService:
+    """
+    Stands in for a Google calendar service object. Every events().list
+    request returns the events given for that calendar, page_size at
+    a time. With a barrier (a threading.Barrier), each request first
+    waits there for the others.
+    """
+    def __init__(self, calendars, page_size=250, barrier=None):
+        self.calendars = calendars
+        self.page_size = page_size
+        self.barrier = barrier
+        self.requests = []
+
+    def events(self):
+        return self
+
+    def list(self, **params):
+        self.requests.append(params)
+        return FakeRequest(self, params)
+
+class FakeRequest:
+    def __init__(self, service, params):
+        self.service = service
+        self.params = params
+
+    def execute(self):
+        if self.service.barrier is not None:
+            self.service.barrier.wait()
+        items = self.service.calendars[self.params["calendarId"]]
+        first = int(self.params.get("pageToken", 0))
+        last = first + self.service.page_size
+        page = {"items": items[first:last]}
+        if last < len(items):
+            page["nextPageToken"] = str(last)
+        return page
+
+class FakeSyncService(FakeService):
+    """
+    A FakeService that also answers syncToken requests with the
+    changes given for each calendar, and 410 Gone for tokens other
+    than the latest one
+    """
+    def __init__(self, calendars, changes=None):
+        FakeService.__init__(self, calendars)
+        self.changes = changes or {}
+        self.token = "token0"
+
+    def list(self, **params):
+        self.requests.append(params)
+        return FakeSyncRequest(self, params)
+
+class FakeSyncRequest(FakeRequest):
+    def execute(self):
+        service = self.service
+        if "syncToken" in self.params:
+            if self.params["syncToken"] != service.token:
+                raise HttpError(httplib2.Response({"status": 410}), b"Gone")
+            page = {"items": service.changes.get(self.params["calendarId"], [])}
+        else:
+            page = FakeRequest.execute(self)
+        if "nextPageToken" not in page:
+            page["nextSyncToken"] = service.token
+        return page
+
+def fake_event(event_id, start, end, summary="Event"):
+    """
+    A google calendar event in the shape the API returns
+    """
+    return {"kind": "calendar#event", "id": event_id, "summary": summary,
+            "start": {"dateTime": start}, "end": {"dateTime": end}}
+
+def fake_calendars(count, per_calendar=5):
+    """
+    count calendars of events, hours apart, on 11/15/2016
+    """
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    calendars = {}
+    for c in range(count):
+        calendars["cal{}".format(c)] = [
+            fake_event("cal{}-{}".format(c, n),
+                       day.replace(hours=+(7 + n), minutes=+c).isoformat(),
+                       day.replace(hours=+(8 + n), minutes=+c).isoformat())
+            for n in range(per_calendar) ]
+    return calendars
+
+def test_fetch_events():
+    """
+    Calendars are fetched at the same time and merged in order of start
+    """
+    calendars = fake_calendars(8)
+    # Each fetch waits until all 8 are under way; fetched one after
+    # another, the first would time out waiting and break the barrier
+    service = FakeService(calendars, barrier=threading.Barrier(8, timeout=10))
+    lower = interpret_time("9:00am")
+    upper = interpret_time("5:00pm")
+
+    events = fetch_events(lambda: service, sorted(calendars), "min", "max",
+                          lower, upper, workers=8)
+
+    assert len(service.requests) == 8
+    assert service.requests[0]["timeMin"] == "min"
+    # 7am events don't reach the 9-5 window
+    assert len(events) == 8 * 4
+    assert [e["start"] for e in events] == sorted(e["start"] for e in events)
+    assert [e["id"] for e in events[:3]] == ["cal0-1", "cal1-1", "cal2-1"]
+
+def test_fetch_events_pages():
+    """
+    Every page is read, asking only for the fields we use
+    """
+    calendars = fake_calendars(2, per_calendar=7)
+    service = FakeService(calendars, page_size=3)
+    events = fetch_events(lambda: service, ["cal0", "cal1"], "min", "max",
+                          interpret_time("12:00am"), interpret_time("11:59pm"))
+    assert len(events) == 14
+    assert len(service.requests) == 2 * 3
+    cal0 = [r for r in service.requests if r["calendarId"] == "cal0"]
+    assert [r.get("pageToken") for r in cal0] == [None, "3", "6"]
+    for request in service.requests:
+        assert request["singleEvents"] == True
+        assert request["orderBy"] == "startTime"
+        assert "items(" in request["fields"]
+
+class FakeFreebusy:
+    """
+    Stands in for service.freebusy(), answering a query with fixed
+    busy blocks and recording the request bodies
+    """
+    def __init__(self, calendars):
+        self.calendars = calendars
+        self.bodies = []
+
+    def freebusy(self):
+        return self
+
+    def query(self, body):
+        self.bodies.append(body)
+        return self
+
+    def execute(self):
+        return {"calendars": self.calendars}
+
+def test_freebusy_appts():
+    """
+    Freebusy blocks become local Appts, split at midnight
+    """
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    def utc(days, hours):
+        return day.replace(days=+days, hours=+hours).to('utc').isoformat()
+    service = FakeFreebusy({
+        "work": {"busy": [{"start": utc(0, 9), "end": utc(0, 11)},
+                          {"start": utc(0, 22), "end": utc(1, 2)}]},
+        "home": {"busy": [], "errors": [{"domain": "global", "reason": "notFound"}]}})
+    appts = freebusy_appts(service, ["work", "home"], day.isoformat(),
+                           day.replace(days=+2).isoformat())
+    assert [item["id"] for item in service.bodies[0]["items"]] == ["work", "home"]
+    assert sorted(str(appt) for appt in appts) == [
+        "2016.11.15 09:00 11:00 | Busy",
+        "2016.11.15 22:00 00:00 | Busy",
+        "2016.11.16 00:00 02:00 | Busy"]
+
+def test_sync_calendar():
+    """
+    The cache lists a calendar once, then asks only for changes
+    """
+    calendars = fake_calendars(1, per_calendar=3)
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    added = fake_event("new", day.replace(hours=+12).isoformat(),
+                       day.replace(hours=+13).isoformat())
+    service = FakeSyncService(calendars, changes={"cal0": [
+        added, {"id": "cal0-0", "status": "cancelled"}]})
+    cache = MemoryCache()
+
+    events = sync_calendar(service, cache, "me", "cal0", day.isoformat())
+    assert sorted(events) == ["cal0-0", "cal0-1", "cal0-2"]
+    # The first listing goes back a while, not to the beginning
+    assert service.requests[0]["timeMin"] == day.replace(days=-flask_main.SYNC_PAST_DAYS).isoformat()
+    assert "nextSyncToken" in service.requests[0]["fields"]
+
+    events = sync_calendar(service, cache, "me", "cal0", day.replace(days=+2).isoformat())
+    assert service.requests[1]["syncToken"] == "token0"
+    assert sorted(events) == ["cal0-1", "cal0-2", "new"]
+
+    # An expired token means listing everything again
+    service.token = "token1"
+    events = sync_calendar(service, cache, "me", "cal0")
+    assert sorted(events) == ["cal0-0", "cal0-1", "cal0-2"]
+    assert "syncToken" not in service.requests[-1]
+    assert cache.get(("me", "cal0")).sync_token == "token1"
+
+    # So does asking for events from before the listing began
+    earlier = day.replace(days=-2 * flask_main.SYNC_PAST_DAYS)
+    sync_calendar(service, cache, "me", "cal0", earlier.isoformat())
+    assert "syncToken" not in service.requests[-1]
+    assert service.requests[-1]["timeMin"] < day.replace(days=-flask_main.SYNC_PAST_DAYS).isoformat()
+
+def test_sync_calendar_window():
+    """
+    A cache entry keeps the window it was listed for through later
+    changes, and a range outside it is listed again
+    """
+    calendars = fake_calendars(1, per_calendar=3)
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    far = arrow.utcnow().replace(days=+2 * flask_main.SYNC_FUTURE_DAYS)
+    calendars["cal0"].append(fake_event("far", far.isoformat(), far.replace(hours=+1).isoformat()))
+    service = FakeSyncService(calendars)
+    cache = MemoryCache()
+
+    events = sync_calendar(service, cache, "me", "cal0", day.isoformat(), day.isoformat())
+    assert sorted(events) == ["cal0-0", "cal0-1", "cal0-2"]    # Not "far"
+    listed = cache.get(("me", "cal0"))
+    sync_calendar(service, cache, "me", "cal0", day.isoformat(), day.isoformat())
+    assert "syncToken" in service.requests[-1]
+    synced = cache.get(("me", "cal0"))
+    assert (synced.since, synced.until) == (listed.since, listed.until)
+
+    # Earlier than the listing goes back, with the sync token still good
+    earlier = day.replace(days=-2 * flask_main.SYNC_PAST_DAYS)
+    sync_calendar(service, cache, "me", "cal0", earlier.isoformat(), day.isoformat())
+    assert "syncToken" not in service.requests[-1]
+    assert service.requests[-1]["timeMin"] == earlier.replace(days=-flask_main.SYNC_PAST_DAYS).isoformat()
+
+    # Later than the listing kept
+    events = sync_calendar(service, cache, "me", "cal0", day.isoformat(), far.isoformat())
+    assert "syncToken" not in service.requests[-1]
+    assert "far" in events
+
+class FakeCalendars:
+    """
+    Stands in for service.calendars(), with a primary calendar
+    """
+    def calendars(self):
+        return self
+
+    def get(self, calendarId, fields=None):
+        assert calendarId == "primary"
+        return self
+
+    def execute(self):
+        return {"id": "someone@example.com"}
+
+def test_google_user():
+    """
+    Cached events are kept under the Google account, not the login
+    """
+    credentials = client.AccessTokenCredentials("token", "test")
+    assert flask_main.google_user(credentials, FakeCalendars()) == "someone@example.com"
+    credentials.id_token = {"sub": "1234", "email": "someone@example.com"}
+    assert flask_main.google_user(credentials, FakeCalendars()) == "1234"
+
+def test_fetch_events_cached():
+    """
+    Cached events are limited to the range and time frame, as
+    fetching them does
+    """
+    calendars = fake_calendars(2)
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    calendars["cal0"].append(fake_event("later", day.replace(days=+3, hours=+10).isoformat(),
+                                        day.replace(days=+3, hours=+11).isoformat()))
+    lower = interpret_time("9:00am")
+    upper = interpret_time("5:00pm")
+    plain = fetch_events(lambda: FakeService(calendars), ["cal0", "cal1"],
+                         day.isoformat(), day.replace(days=+1).isoformat(), lower, upper)
+    service = FakeSyncService(calendars)
+    cache = MemoryCache()
+    for visit in range(2):
+        cached = fetch_events(lambda: service, ["cal0", "cal1"],
+                              day.isoformat(), day.replace(days=+1).isoformat(),
+                              lower, upper, cache=cache, user="me")
+        assert [e["id"] for e in cached] == [e["id"] for e in plain if e["id"] != "later"]
+    assert len(cached) == 8
+    assert [("syncToken" in r) for r in service.requests] == [False, False, True, True]
+
+def test_calendar_discovery():
+    """
+    The discovery document is read once and then reused
+    """
+    saved = flask_main.DISCOVERY_DOC, flask_main._discovery
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump({"name": "calendar", "version": "v3"}, f)
+        f.flush()
+        flask_main.DISCOVERY_DOC = f.name
+        flask_main._discovery = None
+        try:
+            first = flask_main.calendar_discovery()
+            f.seek(0)
+            f.truncate()
+            f.flush()
+            assert flask_main.calendar_discovery() is first
+            assert first["version"] == "v3"
+        finally:
+            flask_main.DISCOVERY_DOC, flask_main._discovery = saved
+
+def test_gcal_service_leases():
+    """
+    A thread asking for several services in one request borrows one
+    Http from the pool, and gives it back when the request ends
+    """
+    saved = flask_main.calendar_discovery, flask_main.discovery.build_from_document
+    flask_main.calendar_discovery = lambda: {}
+    flask_main.discovery.build_from_document = lambda doc, http: http
+    credentials = client.AccessTokenCredentials("token", "test")
+    try:
+        with flask_main.app.test_request_context("/"):
+            before = flask_main.http_pool.metrics()
+            https = [flask_main.get_gcal_service(credentials) for i in range(3)]
+            assert https[0] is https[1] is https[2]
+            assert flask_main.http_pool.metrics()["in_use"] == before["in_use"] + 1
+        assert flask_main.http_pool.metrics()["in_use"] == before["in_use"]
+    finally:
+        flask_main.calendar_discovery, flask_main.discovery.build_from_document = saved
+
+def test_busy_free_days():
+    """
+    Working a day at a time gives the same days as one sweep, and
+    after unticking an event only its day is worked out again
+    """
+    rand = random.Random(2)
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    events = []
+    for n in range(300):
+        begin = day.replace(days=+rand.randrange(60), minutes=+15 * rand.randrange(24, 80))
+        events.append({"id": "e{}".format(n), "summary": "Event {}".format(n % 7),
+                       "start": begin.isoformat(),
+                       "end": begin.replace(minutes=+15 * rand.randrange(1, 12)).isoformat()})
+    events.sort(key=lambda e: e["start"])
+    dStart = day.isoformat()
+    dEnd = day.replace(days=+59).isoformat()
+    tStart = interpret_time("9:00am")
+    tEnd = interpret_time("5:00pm")
+
+    by_day = busy_free_days(bucket_events(events), dStart, dEnd, tStart, tEnd)
+    sweep = get_busy_free_times(events, dStart, dEnd, tStart, tEnd, vectorized=False)
+    for kind in ("busy", "free"):
+        assert [str(ag) for ag in by_day[kind]] == [str(ag) for ag in sweep[kind]]
+
+    before = day_blocks.cache_info()
+    parsed = flask_main.event_epochs.cache_info()
+    kept = [e for e in events if e["id"] != events[100]["id"]]
+    again = busy_free_days(bucket_events(kept), dStart, dEnd, tStart, tEnd)
+    after = day_blocks.cache_info()
+    assert after.misses - before.misses == 1
+    assert after.hits - before.hits == 59
+    # The events were parsed the first time round
+    assert flask_main.event_epochs.cache_info().misses == parsed.misses
+
+    # What one caller does to its Agendas doesn't reach the next
+    again["free"][0].appts.clear()
+    again["busy"][0].appts.clear()
+    third = busy_free_days(bucket_events(kept), dStart, dEnd, tStart, tEnd)
+    assert str(third["free"][0]) == str(by_day["free"][0]) != ""
+    assert str(third["busy"][0]) == str(by_day["busy"][0])
+
+def test_metrics_endpoint():
+    """
+    /metrics is only served when metrics are on, and counts requests
+    """
+    client = flask_main.app.test_client()
+    registry = flask_main.app_metrics
+    saved = registry.enabled
+    try:
+        registry.enabled = False
+        assert client.get("/metrics").status_code == 404
+        registry.enabled = True
+        client.get("/metrics")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        text = response.data.decode("utf-8")
+        assert 'meetme_request_seconds_count{endpoint="show_metrics"}' in text
+        assert "meetme_http_pool_in_use 0" in text
+    finally:
+        registry.enabled = saved
+
+class FailingFreebusy(FakeFreebusy):
+    """
+    A FakeFreebusy whose queries fail with an HTTP status
+    """
+    def __init__(self, status):
+        FakeFreebusy.__init__(self, {})
+        self.status = status
+
+    def execute(self):
+        raise HttpError(httplib2.Response({"status": self.status}), b"Refused")
+
+def test_api_freetimes():
+    """
+    The JSON API answers from the request alone
+    """
+    client = flask_main.app.test_client()
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    query = {"begin_date": "2016-11-15", "end_date": "2016-11-16",
+             "begin_time": "09:00", "end_time": "17:00",
+             "busy": [{"start": day.replace(hours=+10).to('utc').isoformat(),
+                       "end": day.replace(hours=+11).to('utc').isoformat(),
+                       "summary": "Class"},
+                      {"start": day.replace(hours=+22).isoformat(),
+                       "end": day.replace(days=+1, hours=+10).isoformat()}]}
+    response = client.post("/api/v1/freetimes", data=json.dumps(query),
+                           content_type="application/json")
+    assert response.status_code == 200
+    assert "Set-Cookie" not in response.headers
+    assert json.loads(response.data.decode("utf-8")) == {"days": [
+        {"date": "2016-11-15",
+         "busy": [["10:00", "11:00", "Class"], ["22:00", "24:00", "Busy"]],
+         "free": [["09:00", "10:00"], ["11:00", "17:00"]]},
+        {"date": "2016-11-16",
+         "busy": [["00:00", "10:00", "Busy"]],
+         "free": [["10:00", "17:00"]]}]}
+
+    # Calendars' busy times come from Google
+    saved = flask_main.get_gcal_service
+    service = FakeFreebusy({"work": {"busy": [
+        {"start": day.replace(hours=+13).isoformat(), "end": day.replace(hours=+14).isoformat()}]}})
+    flask_main.get_gcal_service = lambda credentials: service
+    try:
+        query = dict(query, busy=[], calendars=["work"])
+        response = client.post("/api/v1/freetimes", data=json.dumps(query),
+                               headers={"Authorization": "Bearer token"})
+        days = json.loads(response.data.decode("utf-8"))["days"]
+        assert days[0]["free"] == [["09:00", "13:00"], ["14:00", "17:00"]]
+        assert service.bodies[0]["items"] == [{"id": "work"}]
+        assert client.post("/api/v1/freetimes", data=json.dumps(query)).status_code == 401
+
+        # Google's refusals are answered as JSON too
+        headers = {"Authorization": "Bearer token"}
+        for status, expected in ((401, 401), (403, 401), (500, 502)):
+            service = FailingFreebusy(status)
+            response = client.post("/api/v1/freetimes", data=json.dumps(query), headers=headers)
+            assert response.status_code == expected
+            assert "error" in json.loads(response.data.decode("utf-8"))
+        bad = dict(query, calendars="primary")
+        assert client.post("/api/v1/freetimes", data=json.dumps(bad),
+                           headers=headers).status_code == 400
+        assert "calendars" in json.loads(client.post(
+            "/api/v1/freetimes", data=json.dumps(dict(query, calendars=[1])),
+            headers=headers).data.decode("utf-8"))["error"]
+    finally:
+        flask_main.get_gcal_service = saved
+
+def test_api_long_busy_block():
+    """
+    A busy block far longer than the date range is cut to the range
+    before it is split into days
+    """
+    client = flask_main.app.test_client()
+    query = {"begin_date": "2016-11-15", "end_date": "2016-11-16",
+             "begin_time": "09:00", "end_time": "17:00",
+             "busy": [{"start": "0001-01-02T00:00:00Z", "end": "9999-12-30T00:00:00Z"}]}
+    split = []
+    saved = flask_main.local_appts
+    def counting(*args):
+        appts = saved(*args)
+        split.extend(appts)
+        return appts
+    flask_main.local_appts = counting
+    try:
+        response = client.post("/api/v1/freetimes", data=json.dumps(query))
+    finally:
+        flask_main.local_appts = saved
+    days = json.loads(response.data.decode("utf-8"))["days"]
+    assert [day["free"] for day in days] == [[], []]
+    assert [day["busy"] for day in days] == [[["00:00", "24:00", "Busy"]]] * 2
+    assert len(split) == 2
+
+    # The range is checked before any busy block is looked at
+    query = dict(query, end_date="2020-11-16")
+    flask_main.local_appts = counting
+    try:
+        assert client.post("/api/v1/freetimes", data=json.dumps(query)).status_code == 400
+    finally:
+        flask_main.local_appts = saved
+    assert len(split) == 2
+
+    bad = [ "not json", {"begin_date": "2016-11-15"},
+            dict(query, calendars=[], end_time="08:00"),
+            dict(query, calendars=[], end_date="2016-11-14"),
+            dict(query, calendars=[], busy=[{"start": "yesterday"}]) ]
+    for body in bad:
+        response = client.post("/api/v1/freetimes", data=json.dumps(body))
+        assert response.status_code == 400
+        assert "error" in json.loads(response.data.decode("utf-8"))
+
+def test_display_freetimes():
+    """
+    Unticked events are dropped from the session, as they always were
+    """
+    client = flask_main.app.test_client()
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    events = [{"kind": "calendar#event", "id": event_id, "summary": event_id, "show": True,
+               "start": day.replace(hours=+hour).isoformat(),
+               "end": day.replace(hours=+hour + 1).isoformat()}
+              for event_id, hour in (("a", 10), ("b", 12), ("c", 14))]
+    with client.session_transaction() as session:
+      session.update({"events": events, "begin_date": day.isoformat(),
+                      "end_date": day.isoformat(),
+                      "begin_time": interpret_time("9:00am"),
+                      "end_time": interpret_time("5:00pm")})
+    assert client.post("/freetime", data={"b": "on"}).status_code == 200
+    with client.session_transaction() as session:
+      assert [e["id"] for e in session["events"]] == ["a", "c"]
+      assert [block["descr"] for block in session["busy"][0]] == ["a", "c"]
+    client.post("/freetime", data={"a": "on"})
+    with client.session_transaction() as session:
+      assert [e["id"] for e in session["events"]] == ["c"]
+
+def test_stream_freetimes():
+    """
+    /freetime/days sends the same days as busy_free_days, as NDJSON
+    or server-sent events, without the events unticked on
+    /freetime/stream
+    """
+    client = flask_main.app.test_client()
+    day = arrow.get("11/15/2016","MM/DD/YYYY").replace(tzinfo=tz.tzlocal())
+    events = [{"id": "a", "summary": "Class", "start": day.replace(hours=+10).isoformat(),
+               "end": day.replace(hours=+11).isoformat()},
+              {"id": "b", "summary": "Lab", "start": day.replace(days=+2, hours=+13).isoformat(),
+               "end": day.replace(days=+2, hours=+15).isoformat()}]
+    dStart = day.isoformat()
+    dEnd = day.replace(days=+3).isoformat()
+    tStart = interpret_time("9:00am")
+    tEnd = interpret_time("5:00pm")
+    with client.session_transaction() as session:
+      session.update({"events": events, "begin_date": dStart, "end_date": dEnd,
+                      "begin_time": tStart, "end_time": tEnd})
+
+    def expected(kept):
+      schedule = busy_free_days(bucket_events(kept), dStart, dEnd, tStart, tEnd)
+      return [flask_main.day_json(day.date().replace(day=15 + n), busy, free)
+              for n, (busy, free) in enumerate(zip(schedule["busy"], schedule["free"]))]
+
+    response = client.get("/freetime/days")
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.data.decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == expected(events)
+    assert len(lines) == 4
+
+    # The form posts the ids of unticked events
+    assert client.post("/freetime/stream", data={"b": "on"}).status_code == 200
+    response = client.get("/freetime/days", headers={"Accept": "text/event-stream"})
+    assert response.mimetype == "text/event-stream"
+    messages = response.data.decode("utf-8").split("\n\n")
+    assert messages[-2:] == ["event: done\ndata: {}", ""]
+    days = [json.loads(message.partition("\ndata: ")[2]) for message in messages[:-2]]
+    assert days == expected(events[:1])
+    assert days[2]["busy"] == []
+    with client.session_transaction() as session:
+      assert [e["id"] for e in session["events"]] == ["a"]
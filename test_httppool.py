@@ -0,0 +1,146 @@
+"""
+Nose tests for httppool.py, against a local HTTP/1.1 server
+"""
+import http.server
+import socketserver
+import threading
+
+from oauth2client import client
+
+from httppool import HttpPool, PoolTimeout
+
+class CountingHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every GET with the Authorization header it got,
+    counting connections and requests on the server"""
+    protocol_version = "HTTP/1.1"   # Keep connections open
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        body = (self.headers.get("Authorization") or "none").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class CountingServer:
+    """A local server in a thread, for 'with'"""
+    def __enter__(self):
+        self.server = ThreadingServer(("127.0.0.1", 0), CountingHandler)
+        self.server.connections = 0
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def test_keep_alive():
+    """
+    Requests through leases of one pool share a connection
+    """
+    pool = HttpPool(max_idle=2)
+    with CountingServer() as server:
+        url = "http://127.0.0.1:{}/".format(server.server_port)
+        for i in range(5):
+            with pool.lease() as http:
+                resp, content = http.request(url)
+                assert resp.status == 200
+        assert server.requests == 5
+        assert server.connections == 1
+        pool.clear()
+    assert pool.metrics() == {"in_use": 0, "idle": 0, "created": 1, "reused": 4,
+                              "waited": 0}
+
+def test_concurrent_leases():
+    """
+    Leases held at the same time get different Http objects, and
+    only max_idle of them are kept afterwards
+    """
+    pool = HttpPool(max_idle=2)
+    leases = [pool.lease() for i in range(3)]
+    assert len(set(id(lease.http) for lease in leases)) == 3
+    assert pool.metrics()["in_use"] == 3
+    for lease in leases:
+        lease.release()
+        lease.release()
+    assert pool.metrics() == {"in_use": 0, "idle": 2, "created": 3, "reused": 0,
+                              "waited": 0}
+
+def test_threads():
+    """
+    Many threads borrowing at once never share an Http
+    """
+    pool = HttpPool(max_idle=4)
+    borrowed = set()
+    lock = threading.Lock()
+    clashes = []
+    def work():
+        for i in range(200):
+            with pool.lease() as lease:
+                with lock:
+                    if id(lease.http) in borrowed:
+                        clashes.append(lease)
+                    borrowed.add(id(lease.http))
+                with lock:
+                    borrowed.discard(id(lease.http))
+    threads = [threading.Thread(target=work) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not clashes
+    metrics = pool.metrics()
+    assert metrics["in_use"] == 0
+    assert metrics["created"] + metrics["reused"] == 8 * 200
+
+def test_max_size():
+    """
+    Past max_size, borrowers wait for an Http to come back, or give up
+    """
+    pool = HttpPool(max_idle=1, max_size=2, factory=object)
+    leases = [pool.lease(), pool.lease()]
+    try:
+        pool.lease(timeout=0.05)
+        assert False, "A third lease should time out"
+    except PoolTimeout:
+        pass
+
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.lease(timeout=5)))
+    waiter.start()
+    leases[0].release()
+    waiter.join()
+    assert len(got) == 1
+    metrics = pool.metrics()
+    assert metrics["in_use"] == 2 and metrics["waited"] == 2
+    assert metrics["created"] == 2 and metrics["reused"] == 1
+
+def test_authorize_lease():
+    """
+    Authorizing a lease doesn't authorize the pooled Http
+    """
+    pool = HttpPool(max_idle=1)
+    credentials = client.AccessTokenCredentials("secret-token", "test")
+    with CountingServer() as server:
+        url = "http://127.0.0.1:{}/".format(server.server_port)
+        with pool.lease() as lease:
+            http = credentials.authorize(lease)
+            resp, content = http.request(url)
+            assert content == b"Bearer secret-token"
+        with pool.lease() as lease:
+            resp, content = lease.request(url)
+            assert content == b"none"
+        assert server.connections == 1
+        pool.clear()
@@ -0,0 +1,49 @@
+"""
+Nose tests for isotime.py
+"""
+import dateutil.parser
+
+# modules we are testing
+import isotime
+
+def test_parse_matches_dateutil():
+    """
+    The fast path gives the same datetimes as dateutil
+    """
+    samples = ["2016-11-15T05:42:00-08:00",
+               "2016-11-15T05:42:00+05:30",
+               "2016-11-15T13:42:00Z",
+               "2016-11-15T13:42:00.25Z",
+               "2016-11-15T13:42:00.123456-07:00",
+               "2016-11-15T13:42",
+               "2016-11-15 13:42:10",
+               "2016-11-15",
+               "Nov 15 2016 1:42pm"]    # Not ISO; dateutil reads it
+    for text in samples:
+        parsed = isotime.parse(text)
+        expected = dateutil.parser.parse(text)
+        assert parsed == expected
+        assert parsed.utcoffset() == expected.utcoffset()
+        assert parsed.isoformat() == expected.isoformat()
+
+def test_parse_cache():
+    """
+    Repeated strings come from the cache
+    """
+    text = "2016-11-16T09:15:00-08:00"
+    before = isotime.cache_info()
+    first = isotime.parse(text)
+    assert isotime.parse(text) is first
+    after = isotime.cache_info()
+    assert after.misses == before.misses + 1
+    assert after.hits == before.hits + 1
+
+def test_parse_bad_date():
+    """
+    Impossible dates raise ValueError
+    """
+    try:
+        isotime.parse("2016-02-30T10:00:00Z")
+        assert False, "February 30 should raise ValueError"
+    except ValueError:
+        pass
@@ -0,0 +1,44 @@
+"""
+Nose tests for metrics.py
+"""
+from metrics import Registry
+
+def test_render():
+    registry = Registry(prefix="app_")
+    hits = registry.counter("hits_total", "Hits", labels=("result",))
+    sizes = registry.histogram("size", "Sizes", buckets=(1, 10))
+    registry.gauge("answer", "The answer", lambda: 42)
+    hits.inc(result="hit")
+    hits.inc(2, result="hit")
+    hits.inc(result='mi"ss')
+    for value in (0.5, 5, 50):
+        sizes.observe(value)
+    with registry.span("work"):
+        pass
+
+    text = registry.render()
+    lines = text.splitlines()
+    assert "# TYPE app_hits_total counter" in lines
+    assert 'app_hits_total{result="hit"} 3' in lines
+    assert 'app_hits_total{result="mi\\"ss"} 1' in lines
+    assert 'app_size_bucket{le="1"} 1' in lines
+    assert 'app_size_bucket{le="10"} 2' in lines
+    assert 'app_size_bucket{le="+Inf"} 3' in lines
+    assert "app_size_sum 55.5" in lines
+    assert "app_size_count 3" in lines
+    assert "app_answer 42" in lines
+    assert 'app_span_seconds_count{span="work"} 1' in lines
+    assert text.endswith("\n")
+
+def test_disabled():
+    """
+    A disabled registry records nothing
+    """
+    registry = Registry(enabled=False)
+    hits = registry.counter("hits_total", "Hits")
+    hits.inc()
+    with registry.span("work"):
+        pass
+    assert hits.value() == 0
+    assert registry.spans.count(span="work") == 0
+    assert registry.span("a") is registry.span("b")
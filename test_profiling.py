@@ -0,0 +1,69 @@
+"""
+Nose tests for profiling.py
+"""
+import datetime
+import json
+import os
+import tempfile
+import time
+
+import flask_main
+import profiling
+
+def busy_wait(seconds):
+    """Something for the sampler to see"""
+    until = time.time() + seconds
+    while time.time() < until:
+        pass
+
+def test_tokens():
+    token = profiling.sign("key", "/freetime", time.time() + 60)
+    assert profiling.verify("key", "/freetime", token)
+    assert not profiling.verify("other key", "/freetime", token)
+    assert not profiling.verify("key", "/display", token)
+    tampered = token[:-1] + ("1" if token[-1] == "0" else "0")
+    assert not profiling.verify("key", "/freetime", tampered)
+    assert not profiling.verify("key", "/freetime", "garbage")
+    old = profiling.sign("key", "/freetime", time.time() - 1)
+    assert not profiling.verify("key", "/freetime", old)
+
+def test_sampler():
+    sampler = profiling.Sampler(interval=0.001)
+    busy_wait(0.1)
+    counts = sampler.stop()
+    assert sampler.samples > 10
+    assert any("busy_wait (test_profiling.py" in stack for stack in counts)
+    for line in profiling.collapsed(counts).splitlines():
+        stack, n = line.rsplit(" ", 1)
+        assert int(n) > 0
+
+def test_requests():
+    """
+    Only requests to the app with a good token are profiled, by the
+    hooks flask_main registers; the spool is kept under its size limit
+    """
+    day = datetime.datetime(2016, 11, 15, 9)
+    busy = [{"start": (day + datetime.timedelta(days=n // 4, hours=n % 4)).isoformat() + "Z",
+             "end": (day + datetime.timedelta(days=n // 4, hours=n % 4, minutes=30)).isoformat() + "Z"}
+            for n in range(1200)]
+    query = json.dumps({"begin_date": "2016-11-15", "end_date": "2017-11-14",
+                        "begin_time": "09:00", "end_time": "17:00", "busy": busy})
+    path = "/api/v1/freetimes"
+    saved = flask_main.profiler
+    with tempfile.TemporaryDirectory() as spool:
+        flask_main.profiler = profiling.Profiler("key", spool, max_bytes=1, interval=0.001)
+        try:
+            client = flask_main.app.test_client()
+            token = profiling.sign("key", path, time.time() + 60)
+            assert client.post(path, data=query).status_code == 200
+            client.post(path + "?profile=bad", data=query)
+            assert os.listdir(spool) == []
+            client.post(path, data=query, headers={profiling.HEADER: token})
+            client.post(path + "?profile=" + token, data=query)
+        finally:
+            flask_main.profiler = saved
+        profiles = os.listdir(spool)
+        assert len(profiles) == 1      # The older one was rotated out
+        assert "api_freetimes" in profiles[0]
+        with open(os.path.join(spool, profiles[0])) as f:
+            assert "api_freetimes (flask_main.py" in f.read()
@@ -0,0 +1,103 @@
+"""
+Nose tests for sessions.py, through a small Flask app
+"""
+import os
+import tempfile
+
+import flask
+
+import sessions
+
+def make_app(interface):
+    """An app that stores and shows session values"""
+    app = flask.Flask(__name__)
+    app.secret_key = "test"
+    app.session_interface = interface
+
+    @app.route("/set/<key>/<value>")
+    def set_value(key, value):
+        flask.session[key] = value
+        return "ok"
+
+    @app.route("/get/<key>")
+    def get_value(key):
+        return flask.session.get(key, "missing")
+
+    @app.route("/clear")
+    def clear():
+        flask.session.clear()
+        return "ok"
+
+    return app
+
+def session_cookie(response):
+    """The session cookie set by a response, or None"""
+    for header in response.headers.getlist("Set-Cookie"):
+        if header.startswith("session="):
+            return header.split(";")[0][len("session="):]
+    return None
+
+def check_backend(interface):
+    app = make_app(interface)
+    client = app.test_client()
+    big = "x" * 10000     # Much more than fits in a cookie
+    response = client.get("/set/big/" + big)
+    cookie = session_cookie(response)
+    assert cookie and len(cookie) < 100
+    assert len(interface.store) == 1
+    assert client.get("/get/big").data.decode() == big
+    # Reading doesn't save the session again
+    assert session_cookie(client.get("/get/big")) is None
+
+    # Another browser has a session of its own
+    other = app.test_client()
+    assert other.get("/get/big").data == b"missing"
+
+    client.get("/clear")
+    assert client.get("/get/big").data == b"missing"
+    assert len(interface.store) == 0     # Empty sessions aren't stored
+
+def test_memory():
+    interface = sessions.open_session_interface("memory")
+    check_backend(interface)
+
+def test_file():
+    with tempfile.TemporaryDirectory() as directory:
+        check_backend(sessions.open_session_interface("file", directory))
+
+def test_sqlite():
+    with tempfile.TemporaryDirectory() as directory:
+        check_backend(sessions.open_session_interface(
+            "sqlite", os.path.join(directory, "sessions.db")))
+
+def test_forged_cookie():
+    """
+    A session id without the right signature starts a new session
+    """
+    interface = sessions.open_session_interface("memory")
+    app = make_app(interface)
+    client = app.test_client()
+    cookie = session_cookie(client.get("/set/user/alice"))
+    sid = cookie.split(".")[0]
+    forged = app.test_client()
+    forged.set_cookie("session", sid + ".forged")
+    assert forged.get("/get/user").data == b"missing"
+
+def test_expiry():
+    store = sessions.MemoryStore(max_sessions=2)
+    store.put("a", b"1", 0)
+    assert store.get("a") is None
+    store.put("b", b"2", 2e9)
+    store.put("c", b"3", 2e9)
+    store.get("b")
+    store.put("d", b"4", 2e9)
+    assert store.get("c") is None and store.get("b") == b"2"
+
+def test_unknown_backend():
+    assert sessions.open_session_interface("cookie") is None
+    for backend in ("file", "redis"):
+        try:
+            sessions.open_session_interface(backend)
+            assert False, "Expected ValueError"
+        except ValueError:
+            pass